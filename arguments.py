@@ -1,3 +1,4 @@
+import os
 import sys
 import argparse
 import datetime as dt
@@ -15,6 +16,18 @@ class Parser:
         self._parser.add_argument('-s', required=True)
         self._parser.add_argument('-e', required=True)
         self._parser.add_argument('-p')
+        # optional settings
+        self._parser.add_argument('--jobs', help="number of processes used to read raw files and of threads used to predict (all cores by default)")
+        self._parser.add_argument('--raw-cache', help="directory where a parquet copy of the raw files is kept")
+        self._parser.add_argument('--state', help="state file of the preprocessing, if it exists only the days after it are processed")
+        self._parser.add_argument('--shards', help="number of shards of ids processed one after the other (or by --jobs processes) to bound the memory used")
+        self._parser.add_argument('--format', default="csv", choices=["csv", "parquet", "feather", "memmap"], help="format of the processed data and predictions (memmap stores the processed data as a memory mapped feature store, read whatever the format, and the predictions as feather)")
+        self._parser.add_argument('--compact', action="store_true", help="preprocesses with categorical ids and float32 features to lower the memory used")
+        self._parser.add_argument('--batch-days', help="number of days of features read and predicted at a time in mode 2 (all at once by default), the predictions being stored by date")
+        self._parser.add_argument('--pipeline', action="store_true", help="overlaps reading, computing and storing: in mode 2 the batches of days (one day by default) are read, predicted and stored by 3 threads, in mode 1 the raw data of the next shard is read while a shard is processed, which needs --shards (at least 2) and --jobs 1 (the processes of --jobs already read their shards in parallel)")
+        self._parser.add_argument('--stage-cache', help="directory where the results of the preprocessing stages are cached, reused by the runs with the same raw files, state, parameters and hmm models")
+        self._parser.add_argument('--stage-cache-size', default="2048", help="maximum size of the stage cache in MB (the least recently used results are removed)")
+        self._parser.add_argument('--profile', nargs="?", const=True, help="prints the time, cpu time, peak memory and rows of each stage (and stores them as json to the path if given)")
         self._args = self._parser.parse_args()
         if int(self._args.m) == 2 and self._args.p == None:
             raise ValueError("Argument -p must be set for mode 2")
@@ -62,3 +75,47 @@ class Parser:
             raise ValueError("could not parse models path (needs to be absolute)")
             
         return mode, inp, out, input_date, end_date, mod
+
+    # gets the optional settings in right format
+    def convert_options(self):
+        options = {}
+        try:
+            options["n_jobs"] = None if self._args.jobs is None else int(self._args.jobs)
+        except:
+            raise ValueError("jobs should be an integer")
+        try:
+            options["raw_cache"] = None if self._args.raw_cache is None else (Path.cwd()/ self._args.raw_cache).resolve()
+        except Exception as e:
+            raise ValueError("could not parse raw cache path")
+        try:
+            options["state"] = None if self._args.state is None else (Path.cwd()/ self._args.state).resolve()
+        except Exception as e:
+            raise ValueError("could not parse state path")
+        try:
+            options["shards"] = None if self._args.shards is None else int(self._args.shards)
+        except:
+            raise ValueError("shards should be an integer")
+        try:
+            options["batch_days"] = None if self._args.batch_days is None else int(self._args.batch_days)
+        except:
+            raise ValueError("batch days should be an integer")
+        try:
+            options["stage_cache"] = None if self._args.stage_cache is None else (Path.cwd()/ self._args.stage_cache).resolve()
+        except Exception as e:
+            raise ValueError("could not parse stage cache path")
+        try:
+            options["stage_cache_size"] = int(self._args.stage_cache_size) * 2**20
+        except:
+            raise ValueError("stage cache size should be an integer")
+        options["storage"] = self._args.format
+        options["compact"] = self._args.compact
+        options["pipeline"] = self._args.pipeline
+        # in mode 1 only the shards processed one after the other are pipelined
+        if int(self._args.m) == 1 and options["pipeline"] and (options["shards"] is None or options["shards"] < 2 or (options["n_jobs"] or os.cpu_count()) > 1):
+            raise ValueError("in mode 1, --pipeline needs --shards (at least 2) and --jobs 1")
+        try:
+            options["profile"] = self._args.profile if self._args.profile in (None, True) else (Path.cwd()/ self._args.profile).resolve()
+        except Exception as e:
+            raise ValueError("could not parse profile path")
+
+        return options
@@ -0,0 +1,234 @@
+import os
+import math
+import argparse
+import tempfile
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from datahandling import DataHandler, STORAGES
+from predictions import Predictor, PREDICT_BATCH_SIZE
+from profiling import Profiler, stage
+
+# predictor of a worker process (loaded once per worker by the initializer of the pool)
+_WORKER_PREDICTOR = None
+# metrics of the windows also reported by market regime
+_REGIME_METRICS = ["days", "r2", "ic"]
+
+
+# windows of length days (of the processed data) starting every step days (length by default, windows not overlapping)
+def rolling_windows(days, length, step=None):
+    days = pd.DatetimeIndex(days)
+    step = step or length
+    if length < 1 or step < 1:
+        raise ValueError("window length and step should be positive")
+    return [(days[first], days[first + length - 1]) for first in range(0, len(days) - length + 1, step)]
+
+
+# windows starting on the first day, the first one of min_length days and each next one step days longer
+# (min_length by default)
+def expanding_windows(days, min_length, step=None):
+    days = pd.DatetimeIndex(days)
+    step = step or min_length
+    if min_length < 1 or step < 1:
+        raise ValueError("window length and step should be positive")
+    return [(days[0], days[last]) for last in range(min_length - 1, len(days), step)]
+
+
+class Backtester:
+    """
+    Walk-forward backtest of the model over windows of days (start, end included): the weighted R2, the information
+    coefficient (mean over the days of the rank correlation of the predictions and the targets of the day, with its
+    standard deviation and their ratio) and both by market regime are reported for every window
+    the processed data of all the windows is read once into a read-only memory mapped matrix of features that the
+    worker processes share, each predicting a part of its rows (the rows of overlapping windows are predicted once),
+    and the metrics of all the windows are computed at once from sums by day
+    """
+    # n_jobs is the number of worker processes (all cores if None), storage as for DataHandler
+    def __init__(self, mod, storage="csv", n_jobs=None, profiler=None):
+        self._mod = mod
+        self._n_jobs = n_jobs or os.cpu_count()
+        self._profiler = profiler
+        self._data_handler = DataHandler(storage, profiler)
+
+    # backtests the windows (list of (start, end)) over the processed data of loc, returning the report (one row by window)
+    def run(self, loc, windows):
+        if len(windows) == 0:
+            raise ValueError("no windows to backtest")
+        starts = pd.DatetimeIndex([pd.Timestamp(start) for start, _ in windows])
+        ends = pd.DatetimeIndex([pd.Timestamp(end) for _, end in windows])
+        if (starts > ends).any():
+            raise ValueError("windows should not end before they start")
+        with stage(self._profiler, "backtest") as record:
+            # only the days of at least one window are predicted
+            days = self._data_handler.processed_days(loc, starts.min(), ends.max())
+            masks = (days.to_numpy() >= starts.to_numpy()[:, None]) & (days.to_numpy() <= ends.to_numpy()[:, None])
+            used = masks.any(axis=0)
+            if not used.any():
+                raise ValueError("no processed data in the windows")
+            days, masks = days[used], masks[:, used]
+            X, y, weights = self._data_handler.read_processed(loc, days[0], days[-1])
+            codes = days.get_indexer(X.index.get_level_values(1))
+            if (codes < 0).any():
+                keep = codes >= 0
+                X, y, weights, codes = X[keep], y[keep], weights[keep], codes[keep]
+
+            with tempfile.TemporaryDirectory() as directory:
+                predictions = self._predict(X, Path(directory) / "features.bin")
+
+            with stage(self._profiler, "metrics") as metrics_record:
+                report = pd.DataFrame({"start": starts, "end": ends})
+                metrics = _window_metrics(masks, codes, y.to_numpy(dtype=float), predictions, weights.to_numpy(dtype=float), X["Market Regime"].to_numpy(dtype=float))
+                report = pd.concat([report, metrics], axis=1)
+                metrics_record["rows"] = len(report)
+            record["rows"] = len(X)
+        return report
+
+    # predicts the rows (as Predictor.predict): their features are written once to a memory mapped file that the
+    # workers read in place, each predicting a part of the rows
+    def _predict(self, X, path):
+        predictor = Predictor(self._mod, num_threads=1 if self._n_jobs > 1 else None)
+        with stage(self._profiler, "features") as record:
+            shape = (len(X), X.shape[1])
+            features = np.memmap(path, dtype=np.float32, mode="w+", shape=shape)
+            for start in range(0, len(X), PREDICT_BATCH_SIZE):
+                features[start:start + PREDICT_BATCH_SIZE] = predictor.features(X.iloc[start:start + PREDICT_BATCH_SIZE])
+            features.flush()
+            record["rows"] = len(X)
+        with stage(self._profiler, "predict") as record:
+            n_chunks = max(1, min(4 * self._n_jobs, math.ceil(len(X) / PREDICT_BATCH_SIZE)))
+            bounds = np.linspace(0, len(X), n_chunks + 1).astype(int)
+            if self._n_jobs > 1 and n_chunks > 1:
+                with ProcessPoolExecutor(max_workers=min(self._n_jobs, n_chunks), initializer=_load_predictor, initargs=(self._mod,)) as executor:
+                    predictions = list(executor.map(_score_rows, [path] * n_chunks, [shape] * n_chunks, bounds[:-1], bounds[1:]))
+            else:
+                predictions = [_predict_rows(predictor, features, start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+            record["rows"] = len(X)
+        return np.concatenate(predictions)
+
+
+def _load_predictor(mod):
+    global _WORKER_PREDICTOR
+    _WORKER_PREDICTOR = Predictor(mod, num_threads=1)
+
+
+# predicts the rows from start to end of the memory mapped features (module level so that it can be sent to workers)
+def _score_rows(path, shape, start, end):
+    return _predict_rows(_WORKER_PREDICTOR, np.memmap(path, dtype=np.float32, mode="r", shape=shape), start, end)
+
+
+# predicts rows of converted features by batches (divided as Predictor.predict does)
+def _predict_rows(predictor, features, start, end):
+    return np.concatenate([predictor.predict_features(features[first:min(first + PREDICT_BATCH_SIZE, end)]) for first in range(start, end, PREDICT_BATCH_SIZE)] + [np.empty(0)]) / 1e4
+
+
+# metrics of every window (rows of masks, the days of each window) from the rows of each day (codes), and from the rows
+# of each market regime (regimes of the rows)
+def _window_metrics(masks, codes, y, predictions, weights, regimes):
+    # the targets are centered to avoid cancellations in the sums of squares
+    center = np.average(y, weights=weights)
+    metrics = _metrics(masks, *_day_sums(codes, y, predictions, weights, center, masks.shape[1]))
+    for regime in np.unique(regimes[~np.isnan(regimes)]):
+        rows = regimes == regime
+        regime_metrics = _metrics(masks, *_day_sums(codes[rows], y[rows], predictions[rows], weights[rows], center, masks.shape[1]))
+        for name in _REGIME_METRICS:
+            metrics[f"{name} regime {regime:g}"] = regime_metrics[name]
+    return pd.DataFrame(metrics)
+
+
+# sums of each day needed by the metrics and information coefficient of each day
+def _day_sums(codes, y, predictions, weights, center, n_days):
+    centered = y - center
+    sums = np.stack([
+        np.bincount(codes, minlength=n_days),
+        np.bincount(codes, weights=weights, minlength=n_days),
+        np.bincount(codes, weights=weights * centered, minlength=n_days),
+        np.bincount(codes, weights=weights * centered ** 2, minlength=n_days),
+        np.bincount(codes, weights=weights * (y - predictions) ** 2, minlength=n_days),
+    ], axis=1)
+    return sums, _daily_ic(codes, y, predictions, n_days)
+
+
+# the weighted R2 is 1 - sum(w (y - p)^2) / (sum(w y^2) - sum(w y)^2 / sum(w)), so the sums over the days of all the
+# windows are the product of the masks and the sums by day, as the sums of the information coefficients
+def _metrics(masks, sums, ic):
+    masks = masks.astype(float)
+    rows, weight, weighted_y, weighted_y2, weighted_errors = (masks @ sums).T
+    valid = ~np.isnan(ic)
+    n_ic = masks @ valid.astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r2 = 1 - weighted_errors / (weighted_y2 - weighted_y ** 2 / weight)
+        ic_mean = (masks @ np.where(valid, ic, 0)) / n_ic
+        ic_std = np.sqrt(np.maximum((masks @ np.where(valid, ic ** 2, 0)) - n_ic * ic_mean ** 2, 0) / (n_ic - 1))
+        ic_ir = ic_mean / ic_std
+    return {"days": (masks @ (sums[:, 0] > 0)).astype(int), "rows": rows.astype(int), "r2": r2, "ic": ic_mean, "ic_std": ic_std, "ic_ir": ic_ir}
+
+
+# rank correlation (spearman) of the predictions and the targets of each day (nan for the days with less than 2 rows
+# or constant values), the ranks within the days being correlated from their sums by day
+def _daily_ic(codes, y, predictions, n_days):
+    target_ranks = pd.Series(y).groupby(codes).rank().to_numpy()
+    prediction_ranks = pd.Series(predictions).groupby(codes).rank().to_numpy()
+    n = np.bincount(codes, minlength=n_days)
+    sum_t, sum_p = np.bincount(codes, target_ranks, n_days), np.bincount(codes, prediction_ranks, n_days)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        covariance = np.bincount(codes, target_ranks * prediction_ranks, n_days) - sum_t * sum_p / n
+        variance_t = np.bincount(codes, target_ranks ** 2, n_days) - sum_t ** 2 / n
+        variance_p = np.bincount(codes, prediction_ranks ** 2, n_days) - sum_p ** 2 / n
+        ic = covariance / np.sqrt(variance_t * variance_p)
+    ic[(n < 2) | ~np.isfinite(ic)] = np.nan
+    return ic
+
+
+def print_report(report):
+    with pd.option_context("display.max_columns", None, "display.width", 200, "display.float_format", "{:.6g}".format):
+        print(report.to_string())
+        print(report[["r2", "ic"]].describe().loc[["mean", "std", "min", "max"]].to_string())
+
+
+def _window(text):
+    try:
+        start, end = text.split(":")
+        return pd.Timestamp(start), pd.Timestamp(end)
+    except Exception:
+        raise ValueError("windows should be of format YYYY-MM-DD:YYYY-MM-DD")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', required=True, help="processed data path")
+    parser.add_argument('-p', required=True, help="models path")
+    parser.add_argument('-o', help="csv file of the report (only printed by default)")
+    parser.add_argument('-s', help="first day of the rolling or expanding windows (YYYY-MM-DD, first day of the data by default)")
+    parser.add_argument('-e', help="last day of the rolling or expanding windows (YYYY-MM-DD, last day of the data by default)")
+    schedule = parser.add_mutually_exclusive_group(required=True)
+    schedule.add_argument('--windows', nargs="+", help="windows as YYYY-MM-DD:YYYY-MM-DD (first and last days)")
+    schedule.add_argument('--rolling', type=int, help="rolling windows of this number of days")
+    schedule.add_argument('--expanding', type=int, help="expanding windows from the first day, the first one of this number of days")
+    parser.add_argument('--step', type=int, help="number of days between the windows of a rolling or expanding schedule (their first length by default)")
+    parser.add_argument('--format', default="csv", choices=list(STORAGES), help="format of the processed data (a feature store is read whatever the format)")
+    parser.add_argument('--jobs', type=int, help="number of worker processes predicting the rows (all cores by default)")
+    parser.add_argument('--profile', action="store_true", help="prints the time, cpu time, peak memory and rows of each stage")
+    args = parser.parse_args()
+
+    inp, mod = (Path.cwd() / args.i).resolve(), (Path.cwd() / args.p).resolve()
+    profiler = Profiler() if args.profile else None
+    backtester = Backtester(mod, args.format, args.jobs, profiler)
+    if args.windows is not None:
+        windows = [_window(window) for window in args.windows]
+    else:
+        start = None if args.s is None else pd.Timestamp(args.s)
+        end = None if args.e is None else pd.Timestamp(args.e)
+        days = DataHandler(args.format).processed_days(inp, start, end)
+        windows = rolling_windows(days, args.rolling, args.step) if args.rolling is not None else expanding_windows(days, args.expanding, args.step)
+    report = backtester.run(inp, windows)
+    print_report(report)
+    if args.o is not None:
+        report.to_csv((Path.cwd() / args.o).resolve(), index=False)
+    if profiler is not None:
+        profiler.print_report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Benchmark of the backtest of many windows (backtesting.Backtester) against one pass of mode 2 over the whole history
+(reading, predicting and evaluating all the days) and against scoring the windows one by one as separate runs of
+mode 2 do (without the start of the interpreter and the loading of the model of each run), the metrics of the windows
+being compared to the ones computed with sklearn and scipy
+
+usage (from the repository root): python -m benchmarks.backtest [processed_path] [--format csv] [--windows 50 --length 20]
+[--jobs n] (a synthetic dataset of --ids ids over --days days is stored as parquet when no processed path is given)
+"""
+import time
+import argparse
+import tempfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scipy.stats import spearmanr
+from sklearn.metrics import r2_score
+
+from datahandling import DataHandler
+from predictions import Predictor
+from backtesting import Backtester, rolling_windows
+from benchmarks.storage_formats import synthetic_dataset
+
+
+# scores a window as a run of mode 2 does, returning its weighted R2, information coefficient and R2 by market regime
+def score_window(d, p, loc, start, end):
+    X, y, weights = d.read_processed(loc, start, end)
+    y_preds = p.predict(X)
+    rows = pd.DataFrame({"y": y.to_numpy(), "p": y_preds, "day": X.index.get_level_values(1)})
+    ic = rows.groupby("day").apply(lambda day: spearmanr(day["y"], day["p"])[0]).mean()
+    regimes = X["Market Regime"].to_numpy(dtype=float)
+    by_regime = {regime: r2_score(y[regimes == regime], y_preds[regimes == regime], sample_weight=weights[regimes == regime]) for regime in np.unique(regimes)}
+    return r2_score(y, y_preds, sample_weight=weights), ic, by_regime
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("processed", nargs="?", help="processed data path")
+    parser.add_argument("--format", default="csv")
+    parser.add_argument("--ids", default=1000, type=int)
+    parser.add_argument("--days", default=252, type=int)
+    parser.add_argument("--windows", default=50, type=int, help="number of rolling windows")
+    parser.add_argument("--length", default=20, type=int, help="days of the windows")
+    parser.add_argument("--jobs", type=int)
+    parser.add_argument("--models", default="models")
+    args = parser.parse_args()
+    mod = Path(args.models).resolve()
+
+    with tempfile.TemporaryDirectory() as root:
+        if args.processed is None:
+            loc, storage = Path(root), "parquet"
+            DataHandler(storage).store_dataset(loc, synthetic_dataset(args.ids, args.days))
+        else:
+            loc, storage = Path(args.processed).resolve(), args.format
+        d = DataHandler(storage)
+        days = d.processed_days(loc)
+        windows = rolling_windows(days, args.length, max(1, (len(days) - args.length) // max(1, args.windows - 1)))[:args.windows]
+
+        start = time.perf_counter()
+        X, y, weights = d.read_processed(loc)
+        p = Predictor(mod)
+        r2_score(y, p.predict(X), sample_weight=weights)
+        one_pass = time.perf_counter() - start
+        print(f"{len(days)} days, {len(X)} rows: one pass of mode 2 over the history {one_pass:.2f}s")
+        del X, y, weights
+
+        start = time.perf_counter()
+        report = Backtester(mod, storage, n_jobs=args.jobs).run(loc, windows)
+        backtest = time.perf_counter() - start
+        print(f"backtest of {len(windows)} windows of {args.length} days: {backtest:.2f}s ({backtest / one_pass:.2f} passes)")
+
+        start = time.perf_counter()
+        r2_diff = ic_diff = 0
+        for i, (window_start, window_end) in enumerate(windows):
+            r2, ic, by_regime = score_window(d, p, loc, window_start, window_end)
+            r2_diff = max(r2_diff, abs(r2 - report["r2"][i]), *[abs(value - report[f"r2 regime {regime:g}"][i]) for regime, value in by_regime.items()])
+            ic_diff = max(ic_diff, abs(ic - report["ic"][i]))
+        print(f"windows scored one by one: {time.perf_counter() - start:.2f}s (with the metrics of sklearn and scipy)")
+        print(f"largest difference to sklearn and scipy: R2 {r2_diff:.2e}, information coefficient {ic_diff:.2e}")
+
+
+if __name__ == "__main__":
+    main()
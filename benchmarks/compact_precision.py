@@ -0,0 +1,55 @@
+"""
+Peak memory of each stage of the preprocessing and precision of the compact mode against the float64 one
+
+usage (from the repository root): python -m benchmarks.compact_precision raw_data_path [models_path]
+"""
+import sys
+import warnings
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from datahandling import DataHandler
+from predictions import Predictor
+from preprocessing import Preprocessor
+from profiling import Profiler
+
+
+def run(inp, mod, compact):
+    profiler = Profiler()
+    raw_data = DataHandler(profiler=profiler).read_raw(inp, n_jobs=1, compact=compact)
+    dataset = Preprocessor(raw_data, mod, compact=compact, profiler=profiler).create_dataset()
+    return dataset, profiler
+
+
+def main():
+    warnings.filterwarnings("ignore")
+    inp = Path(sys.argv[1]).resolve()
+    mod = Path(sys.argv[2] if len(sys.argv) > 2 else "models").resolve()
+
+    full, full_profiler = run(inp, mod, compact=False)
+    compact, compact_profiler = run(inp, mod, compact=True)
+    for name, profiler in [("float64", full_profiler), ("compact", compact_profiler)]:
+        print(f"{name}:")
+        profiler.print_report()
+
+    # precision by group of columns (the rows and ids are the same)
+    pd.testing.assert_index_equal(full.index, compact.index)
+    print("max absolute / relative error of the compact mode:")
+    groups = {"ResidReturnD": "ResidReturnD-", "ResidReturnT": "ResidReturnT-", "Volume": "Volume-", "Market Regime": "Market Regime", "Sample Weights": "Sample Weights", "Target": "Target"}
+    for name, prefix in groups.items():
+        columns = full.columns[full.columns.str.startswith(prefix)]
+        expected, result = full[columns].to_numpy(dtype=float), compact[columns].to_numpy(dtype=float)
+        error = np.abs(result - expected)
+        print(f"  {name}: {np.nanmax(error):.3g} / {np.nanmax(error / np.maximum(np.abs(expected), 1e-12)):.3g}")
+
+    # effect on the predictions
+    X_full = full.drop(["Sample Weights", "Target"], axis=1)
+    X_compact = compact.drop(["Sample Weights", "Target"], axis=1).astype({"Market Regime": "float64"})
+    predictor = Predictor(mod)
+    preds_full, preds_compact = predictor.predict(X_full), predictor.predict(X_compact)
+    print(f"max absolute difference of the predictions: {np.max(np.abs(preds_full - preds_compact)):.3g} (prediction std {np.std(preds_full):.3g})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Benchmark of the compiled models (see compiled.py) against lightgbm and hmmlearn: load time, exactness of the predictions
+and regimes on held-out synthetic rows, and latency of single rows and batches
+
+usage (from the repository root): python -m benchmarks.compiled_latency [n_ids] [n_days] [batch_size ...]
+"""
+import sys
+import time
+import pickle
+import tempfile
+from pathlib import Path
+import numpy as np
+
+from compiled import compile_models, CompiledModels
+from preprocessing import load_hmm_models, predict_regimes
+from benchmarks.storage_formats import synthetic_dataset
+
+
+# features as given to lightgbm (float32, market regime as the position among the training regimes) with missing
+# values, values read as 0 and regimes unknown to the model
+def held_out_features(n_ids, n_days, seed=1):
+    rng = np.random.default_rng(seed)
+    X = synthetic_dataset(n_ids, n_days, seed=seed).drop(["Sample Weights", "Target"], axis=1)
+    features = X.to_numpy(dtype=np.float32)
+    features[rng.random(features.shape) < 0.02] = np.nan
+    features[rng.random(features.shape) < 0.01] = 0
+    regime = X.columns.get_loc("Market Regime")
+    features[:, regime] = rng.choice([0, 1, 2, 3, -1, np.nan], len(features), p=[0.3, 0.3, 0.3, 0.04, 0.03, 0.03])
+    return features
+
+
+# median latency (in milliseconds) of calls of function on successive slices of batch_size rows
+def latency(function, features, batch_size, repeats=200):
+    times = []
+    for i in range(repeats):
+        start = (i * batch_size) % max(len(features) - batch_size, 1)
+        batch = features[start:start + batch_size].copy()
+        begin = time.perf_counter()
+        function(batch)
+        times.append(time.perf_counter() - begin)
+    return np.median(times) * 1e3
+
+
+def main():
+    n_ids = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    n_days = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    batch_sizes = [int(n) for n in sys.argv[3:]] or [1, 100, 10000]
+    mod = Path("models")
+
+    with tempfile.TemporaryDirectory() as root:
+        path = Path(root) / "compiled.bin"
+        compile_models(mod, path)
+        print(f"compiled models: {path.stat().st_size / 2**10:.1f}KB")
+
+        start = time.perf_counter()
+        with open(mod / "lgb_model1.pkl", "rb") as file:
+            booster = pickle.load(file).booster_
+        hmm_models = load_hmm_models(mod)
+        pickled_time = time.perf_counter() - start
+        start = time.perf_counter()
+        compiled = CompiledModels(path)
+        compiled_time = time.perf_counter() - start
+        print(f"load: pickled models {pickled_time * 1e3:.1f}ms, compiled models {compiled_time * 1e3:.2f}ms")
+
+        features = held_out_features(n_ids, n_days)
+        expected, result = booster.predict(features), compiled.predict(features)
+        print(f"{len(features)} held-out rows: {np.count_nonzero(expected != result)} predictions differ from lightgbm")
+        rng = np.random.default_rng(2)
+        index_returns = rng.normal(0, 0.01, 2 * n_days)
+        expected, result = predict_regimes(hmm_models, index_returns), compiled.predict_regimes(index_returns)
+        print(f"{len(index_returns)} days: {np.count_nonzero(expected != result)} regimes differ from hmmlearn")
+
+        for batch_size in batch_sizes:
+            lightgbm_ms = latency(lambda batch: booster.predict(batch, num_threads=1), features, batch_size)
+            compiled_ms = latency(compiled.predict, features, batch_size)
+            print(f"  batches of {batch_size} rows: lightgbm {lightgbm_ms:.3f}ms, compiled {compiled_ms:.3f}ms")
+        start = time.perf_counter()
+        predict_regimes(hmm_models, index_returns)
+        hmmlearn_ms = (time.perf_counter() - start) * 1e3
+        start = time.perf_counter()
+        compiled.predict_regimes(index_returns)
+        compiled_ms = (time.perf_counter() - start) * 1e3
+        print(f"  regimes of {len(index_returns)} days: hmmlearn {hmmlearn_ms:.2f}ms, compiled {compiled_ms:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Benchmark of the whole pipeline: mode 1 (preprocessing) then mode 2 (predictions) of main.py on synthetic raw data
+of several sizes, with the profile of every stage (wall time, cpu time, peak memory, rows) stored as json
+
+usage (from the repository root): python -m benchmarks.pipeline [--scales 50x20 200x60 ...] [--report path] [main options]
+(the other options, e.g. --shards 4 --jobs 2 --format parquet --compact, are given to both modes of main.py)
+"""
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+from benchmarks.synthetic_raw import generate_raw
+
+
+# runs main.py in a new process (as it is run in production) and returns the stages of its profile
+def run_main(mode, inp, out, start, end, mod, report, options):
+    command = [sys.executable, "main.py", "-m", str(mode), "-i", str(inp), "-o", str(out), "-s", start, "-e", end,
+               "-p", str(mod), "--profile", str(report)] + options
+    wall = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    wall = time.perf_counter() - wall
+    with open(report) as file:
+        return wall, json.load(file)["stages"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", nargs="+", default=["50x20", "200x60", "500x120"], help="sizes of the raw data (ids x days)")
+    parser.add_argument("--report", default="pipeline_benchmark.json", help="json file of the profiles of all the runs")
+    parser.add_argument("--models", default="models")
+    args, options = parser.parse_known_args()
+    mod = Path(args.models).resolve()
+
+    runs = []
+    for scale in args.scales:
+        n_ids, n_days = (int(n) for n in scale.split("x"))
+        with tempfile.TemporaryDirectory() as root:
+            root = Path(root)
+            generate_raw(root / "raw", n_ids, n_days)
+            (root / "processed").mkdir()
+            (root / "predictions").mkdir()
+            start, end = "2015-01-01", "2030-01-01"
+            for mode, inp, out in [(1, root / "raw", root / "processed"), (2, root / "processed", root / "predictions")]:
+                wall, stages = run_main(mode, inp, out, start, end, mod, root / "report.json", options)
+                runs.append({"n_ids": n_ids, "n_days": n_days, "mode": mode, "options": options, "wall_time_s": wall, "stages": stages})
+                print(f"{n_ids} ids x {n_days} days, mode {mode}: {wall:.2f}s (with the start of the interpreter)")
+                for stage in stages:
+                    rows = "" if stage["rows"] is None else f", {stage['rows']} rows"
+                    print(f"  {'  ' * stage['depth']}{stage['stage']}: {stage['wall_time_s']:.2f}s (cpu {stage['cpu_time_s']:.2f}s), "
+                          f"peak {stage['peak_memory_mb']:.1f}MB{rows}")
+
+    with open(args.report, "w") as file:
+        json.dump({"runs": runs}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
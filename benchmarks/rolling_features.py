@@ -0,0 +1,88 @@
+"""
+Benchmark of Preprocessor.create_rolling_features against the former per id loop
+
+usage (from the repository root): python -m benchmarks.rolling_features [n_days] [n_ids ...]
+"""
+import sys
+import time
+import datetime as dt
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from preprocessing import Preprocessor
+
+
+# generates intraday features (26 ticks a day) and targets for n_ids ids over n_days days
+def synthetic_features(n_ids, n_days, seed=0):
+    rng = np.random.default_rng(seed)
+    days = pd.bdate_range("2020-01-02", periods=n_days)
+    ticks = (days.values[:, None] + pd.timedelta_range("09:45:00", "16:00:00", freq="15min").values[None, :]).ravel()
+    index = pd.MultiIndex.from_product([np.arange(n_ids), ticks])
+    intraday_features = pd.DataFrame({"ResidReturn": rng.normal(0, 1e-3, len(index)), "Volume": rng.integers(100, 10000, len(index)).astype(float)}, index=index)
+    target = pd.Series(rng.normal(0, 1, n_ids * n_days), index=pd.MultiIndex.from_product([np.arange(n_ids), days]), name="Target")
+    return intraday_features, target
+
+
+# former implementation: one padded frame and one strided window per id
+def legacy_rolling_features(p, daily_ticks=20, intraday_ticks=26):
+    p._daily_features = p._target.groupby(level=0).shift(1).dropna()
+
+    def strided_app(a, L):
+        nrows = ((a.size-L))+1
+        n = a.strides[0]
+        return np.lib.stride_tricks.as_strided(a, shape=(nrows,L), strides=(n,n))
+
+    intraday_data = []
+    for Id, id_data in p._intraday_features.groupby(level=0):
+        start_index = id_data.index.get_level_values(1)[0]
+        filled_up_index = pd.date_range(start=start_index - pd.DateOffset(minutes=15*intraday_ticks), end=start_index, freq="15T", inclusive="left")
+        filled_up_df = pd.DataFrame(np.nan, index=pd.MultiIndex.from_arrays([[Id] * len(filled_up_index), filled_up_index]), columns=id_data.columns)
+        id_data = pd.concat([filled_up_df, id_data])
+        arr = np.stack([strided_app(id_data["ResidReturn"].to_numpy(copy=False),L=intraday_ticks), strided_app(id_data["Volume"].to_numpy(copy=False),L=intraday_ticks)], axis=1)
+        mask = id_data.index[intraday_ticks-1:].get_level_values(1).time == dt.time(15,30)
+        days = id_data.index[intraday_ticks-1:].get_level_values(1)[mask].normalize()
+        intraday_data.append(pd.DataFrame(arr[mask].reshape(-1, intraday_ticks * 2), index=pd.MultiIndex.from_arrays([[Id] * len(days), days])))
+    rolling_intraday_features = pd.concat(intraday_data)
+    rolling_intraday_features.columns = ["ResidReturnT-" + str(i) for i in range(rolling_intraday_features.shape[1]//2, 0, -1)] + ["Volume-" + str(i) for i in range(rolling_intraday_features.shape[1]//2, 0, -1)]
+
+    daily_data = []
+    for Id, id_data in p._daily_features.groupby(level=0):
+        start_index = id_data.index.get_level_values(1)[0]
+        filled_up_index = pd.date_range(start=start_index - pd.DateOffset(days=daily_ticks), end=start_index, freq="D", inclusive="left")
+        filled_up_df = pd.Series(np.nan, index=pd.MultiIndex.from_arrays([[Id] * len(filled_up_index), filled_up_index]), name=id_data.name)
+        id_data = pd.concat([filled_up_df, id_data], axis=0)
+        arr = strided_app(id_data.to_numpy(copy=False),L=daily_ticks)
+        daily_data.append(pd.DataFrame(arr, index=id_data.index[daily_ticks-1:]))
+    rolling_daily_features = pd.concat(daily_data)
+    rolling_daily_features.columns = ["ResidReturnD-" + str(i) for i in range(rolling_daily_features.shape[1], 0, -1)]
+
+    return pd.concat([rolling_daily_features, rolling_intraday_features], axis=1).sort_index()
+
+
+def main():
+    n_days = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    universe_sizes = [int(n) for n in sys.argv[2:]] or [500, 2000, 5000]
+
+    for n_ids in universe_sizes:
+        intraday_features, target = synthetic_features(n_ids, n_days)
+        p = Preprocessor(None, Path("models"))
+        p._target = target
+        # only timing the windowing (the tick returns are given)
+        p.create_raw_intraday_features = lambda: intraday_features
+        p._intraday_features = intraday_features
+
+        start = time.perf_counter()
+        expected = legacy_rolling_features(p)
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        result = p.create_rolling_features()
+        batched_time = time.perf_counter() - start
+
+        pd.testing.assert_frame_equal(result, expected, check_exact=True)
+        print(f"{n_ids} ids x {n_days} days: loop {legacy_time:.2f}s, batched {batched_time:.2f}s, speedup x{legacy_time / batched_time:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmark of Predictor.predict (batches of float32 rows) against the former single call on the whole pandas frame
+
+usage (from the repository root): python -m benchmarks.scoring [n_ids] [n_days] [batch_size ...] (0 for all the rows at once)
+"""
+import os
+import sys
+import time
+import pickle
+import tracemalloc
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from predictions import Predictor
+from benchmarks.storage_formats import synthetic_dataset
+
+
+# former implementation: the market regime of the frame is cast to category and the whole frame is given to lightgbm
+def legacy_predict(model, X):
+    X['Market Regime'] = X['Market Regime'].astype('category')
+    return model.predict(X) / 1e4
+
+
+# time and peak memory allocated by python (the copies of the features) of a call
+def measure(function, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    n_ids = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    n_days = int(sys.argv[2]) if len(sys.argv) > 2 else 252
+    batch_sizes = [int(n) for n in sys.argv[3:]] or [0, 65536, 8192]
+    mod = Path("models")
+    dataset = synthetic_dataset(n_ids, n_days)
+    X = dataset.drop(["Sample Weights", "Target"], axis=1)
+    X["Market Regime"] = X["Market Regime"].astype("category")
+
+    with open(mod / "lgb_model1.pkl", "rb") as file:
+        model = pickle.load(file)
+    expected, legacy_time, legacy_peak = measure(legacy_predict, model, X.copy())
+    print(f"{len(X)} rows: single call on the frame {legacy_time:.2f}s, peak {legacy_peak:.0f}MB")
+
+    for num_threads in sorted({1, os.cpu_count()}):
+        predictor = Predictor(mod, num_threads=num_threads)
+        for batch_size in batch_sizes:
+            before = X.copy()
+            result, elapsed, peak = measure(predictor.predict, X, batch_size)
+            pd.testing.assert_frame_equal(X, before)
+            # the float32 rows only change the predictions of values rounded across a threshold of the trees
+            changed = np.count_nonzero(result != expected)
+            print(f"  {num_threads} threads, batches of {batch_size or len(X)} rows: {elapsed:.2f}s, peak {peak:.0f}MB, "
+                  f"{changed} predictions changed (max difference {np.max(np.abs(result - expected)):.3g})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Benchmark of the stage cache of the preprocessing (see stagecache.StageCache): the dataset of synthetic raw data is
+created without cache, with an empty cache, again with the same parameters (every stage is reused) and with other
+rolling windows (only the target and the weights are reused), each dataset being compared to the one created without
+cache with the same parameters
+
+usage (from the repository root): python -m benchmarks.stage_cache [--ids n --days n --daily-ticks n --max-mb n]
+"""
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+from datahandling import DataHandler
+from preprocessing import Preprocessor
+from stagecache import StageCache
+from benchmarks.synthetic_raw import generate_raw
+
+
+def create_dataset(raw_df, mod, cache, daily_ticks):
+    wall = time.perf_counter()
+    dataset = Preprocessor(raw_df, mod, cache=cache).create_dataset(daily_ticks=daily_ticks)
+    return dataset, time.perf_counter() - wall
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ids", default=500, type=int)
+    parser.add_argument("--days", default=120, type=int)
+    parser.add_argument("--daily-ticks", default=10, type=int, help="rolling window of the daily features of the sweep run")
+    parser.add_argument("--max-mb", default=2048, type=int, help="size of the cache")
+    parser.add_argument("--models", default="models")
+    args = parser.parse_args()
+    mod = Path(args.models).resolve()
+
+    with tempfile.TemporaryDirectory() as root:
+        root = Path(root)
+        generate_raw(root / "raw", args.ids, args.days)
+        wall = time.perf_counter()
+        raw_df = DataHandler().read_raw(root / "raw", n_jobs=1)
+        print(f"{args.ids} ids x {args.days} days: {len(raw_df)} raw rows read in {time.perf_counter() - wall:.2f}s (not cached)")
+
+        reference, wall = create_dataset(raw_df, mod, None, 20)
+        print(f"without cache: {wall:.2f}s")
+        cache = StageCache(root / "cache", args.max_mb * 2**20)
+        for name, daily_ticks in [("empty cache", 20), ("same parameters", 20), (f"daily ticks {args.daily_ticks}", args.daily_ticks)]:
+            if daily_ticks != 20:
+                reference, _ = create_dataset(raw_df, mod, None, daily_ticks)
+            dataset, wall = create_dataset(raw_df, mod, cache, daily_ticks)
+            print(f"{name}: {wall:.2f}s, equal to the dataset without cache: {dataset.equals(reference)}")
+        cache.print_stats()
+        print(f"cache size: {sum(file.stat().st_size for file in (root / 'cache').glob('*.pkl')) / 2**20:.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
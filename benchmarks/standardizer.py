@@ -0,0 +1,94 @@
+"""
+Benchmark of the Standardizer against the former per id implementation, and of its updates day by day
+
+usage (from the repository root): python -m benchmarks.standardizer [n_days] [n_ids ...]
+"""
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+from preprocessing import Standardizer
+
+
+# generates n_columns features of n_ids ids over n_days days (with missing values and ids without history)
+def synthetic_features(n_ids, n_days, n_columns=1, seed=0):
+    rng = np.random.default_rng(seed)
+    days = pd.bdate_range("2020-01-02", periods=n_days)
+    index = pd.MultiIndex.from_product([np.arange(n_ids), days])
+    values = rng.normal(rng.normal(0, 1, (n_ids, 1, n_columns)), rng.uniform(0.5, 2, (n_ids, 1, n_columns)), (n_ids, n_days, n_columns))
+    values[rng.random(values.shape) < 0.05] = np.nan
+    # ids with a single day have no std
+    values[:n_ids // 100, 1:] = np.nan
+    return pd.DataFrame(values.reshape(-1, n_columns), index=index, columns=[f"Feature-{i}" for i in range(n_columns)])
+
+
+class LegacyStandardizer:
+    """
+    Former implementation: dictionaries of the statistics and a function applied to every id
+    """
+    def fit(self, series):
+        exp_series = series.unstack(level=0)
+        means = exp_series.mean()
+        self._means_dict = means.to_dict()
+        self._means_dict["_MEAN"] = means.mean()
+        stds = exp_series.std()
+        self._stds_dict = stds.to_dict()
+        self._stds_dict["_MEAN"] = stds.mean()
+        return self
+
+    def transform(self, series):
+        exp_series = series.unstack(level=0)
+        def normalize(col):
+            try:
+                mean = self._means_dict[col.name]
+                std = self._stds_dict[col.name]
+                if pd.isnull(std):
+                    return col
+                else:
+                    return (col - mean) / std
+            except:
+                return (col - self._means_dict["_MEAN"]) / self._stds_dict["_MEAN"]
+
+        return exp_series.apply(normalize)
+
+
+def main():
+    n_days = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    universe_sizes = [int(n) for n in sys.argv[2:]] or [1000, 5000]
+
+    for n_ids in universe_sizes:
+        series = synthetic_features(n_ids, n_days)["Feature-0"]
+        # the last ids are not fitted
+        fitted = series[series.index.get_level_values(0) < n_ids * 9 // 10]
+
+        start = time.perf_counter()
+        expected = LegacyStandardizer().fit(fitted).transform(series)
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        result = Standardizer().fit(fitted).transform(series)
+        vectorized_time = time.perf_counter() - start
+
+        pd.testing.assert_frame_equal(result, expected, rtol=1e-12)
+        print(f"one series, {n_ids} ids x {n_days} days: legacy {legacy_time:.2f}s, vectorized {vectorized_time:.2f}s, speedup x{legacy_time / vectorized_time:.1f}")
+
+        # all the rolling columns of a dataset at once, fitted at once or day by day
+        features = synthetic_features(n_ids, n_days, n_columns=72)
+        start = time.perf_counter()
+        standardizer = Standardizer().fit(features)
+        standardizer.transform(features)
+        wide_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        streaming = Standardizer()
+        for _, day in features.groupby(level=1):
+            streaming.partial_fit(day)
+        streaming_time = time.perf_counter() - start
+        np.testing.assert_allclose(streaming.means(), standardizer.means(), rtol=1e-9, atol=1e-12)
+        np.testing.assert_allclose(streaming.stds(), standardizer.stds(), rtol=1e-9)
+        print(f"72 columns, {n_ids} ids x {n_days} days: fit and transform {wide_time:.2f}s, {n_days} daily updates {streaming_time:.2f}s ({streaming_time / n_days * 1e3:.1f}ms a day)")
+
+
+if __name__ == "__main__":
+    main()
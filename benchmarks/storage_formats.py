@@ -0,0 +1,68 @@
+"""
+Benchmark of the storages of the processed data: time to read a year of features (mode 2) from each format, and a
+month, two columns or ten ids of it
+
+usage (from the repository root): python -m benchmarks.storage_formats [n_ids] [n_days]
+"""
+import sys
+import time
+import tempfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from datahandling import DataHandler, STORAGES
+
+
+# generates a processed dataset (same columns as Preprocessor.create_dataset) of n_ids ids over n_days days
+def synthetic_dataset(n_ids, n_days, seed=0):
+    rng = np.random.default_rng(seed)
+    days = pd.bdate_range("2020-01-02", periods=n_days)
+    index = pd.MultiIndex.from_product([np.arange(n_ids), days]).swaplevel().sort_values().swaplevel()
+    columns = ["ResidReturnD-" + str(i) for i in range(20, 0, -1)] + ["ResidReturnT-" + str(i) for i in range(26, 0, -1)] + ["Volume-" + str(i) for i in range(26, 0, -1)]
+    dataset = pd.DataFrame(rng.normal(0, 10, (len(index), len(columns))), index=index, columns=columns)
+    dataset["Market Regime"] = rng.integers(0, 3, len(index)).astype(float)
+    dataset["Sample Weights"] = rng.uniform(0, 1, len(index)) / n_ids
+    dataset["Target"] = rng.normal(0, 1, len(index))
+    return dataset.sort_index()
+
+
+def main():
+    n_ids = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    n_days = int(sys.argv[2]) if len(sys.argv) > 2 else 252
+    dataset = synthetic_dataset(n_ids, n_days)
+    days = dataset.index.get_level_values(1)
+    month = (days[len(days) // 2], days[len(days) // 2] + pd.Timedelta(days=30))
+
+    for storage in STORAGES:
+        d = DataHandler(storage)
+        with tempfile.TemporaryDirectory() as out:
+            out = Path(out)
+            start = time.perf_counter()
+            d.store_dataset(out, dataset)
+            store_time = time.perf_counter() - start
+            size = sum(file.stat().st_size for file in out.iterdir()) / 2**20
+
+            start = time.perf_counter()
+            X, y, weights = d.read_processed(out)
+            read_time = time.perf_counter() - start
+            assert X.shape == (len(dataset), dataset.shape[1] - 2)
+
+            start = time.perf_counter()
+            d.read_processed(out, *month)
+            month_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            d.read_processed(out, columns=["ResidReturnD-1", "Market Regime"])
+            columns_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            d.read_processed(out, ids=range(10))
+            ids_time = time.perf_counter() - start
+
+        print(f"{storage}: {n_ids} ids x {n_days} days, {size:.0f}MB, store {store_time:.2f}s, read {read_time:.2f}s, "
+              f"read a month {month_time:.2f}s, read 2 columns {columns_time:.2f}s, read 10 ids {ids_time:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Consistency check of the FeatureStreamer against the batch preprocessing: the days after the first ones of historical
+raw files are replayed bar by bar through the streamer and processed by incremental runs of the Preprocessor (one per
+day, as in production), and the rows emitted at 15:30 are compared to the rows stored by the batch runs
+
+usage (from the repository root): python -m benchmarks.streaming_replay [raw_path] [first_days] [--ids n --days n]
+(synthetic raw data of n ids over n days is generated when no raw path is given)
+"""
+import sys
+import time
+import argparse
+import tempfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from datahandling import DataHandler
+from preprocessing import Preprocessor
+from streaming import FeatureStreamer
+from benchmarks.synthetic_raw import generate_raw
+
+
+# bars of a day of the intraday file, grouped by time
+def replay_day(streamer, raw, day):
+    bars = pd.read_csv(raw / "intraday_data" / f"{day:%Y%m%d}.csv")
+    daily = pd.read_csv(raw / "daily_data" / f"data{day:%Y%m%d}.csv").set_index("ID")
+    streamer.start_day(day, daily)
+    rows, latencies = [], []
+    for bar_time, bar in bars.groupby("Time"):
+        start = time.perf_counter()
+        emitted = streamer.update(day + pd.Timedelta(bar_time), bar["Id"].to_numpy(), bar["CumReturnResid"].to_numpy(), bar["CumVolume"].to_numpy())
+        latencies.append(time.perf_counter() - start)
+        if emitted is not None:
+            rows.append(emitted)
+    emitted = streamer.end_day()
+    if emitted is not None:
+        rows.append(emitted)
+    return rows, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("raw", nargs="?", help="raw data path (intraday_data and daily_data)")
+    parser.add_argument("first_days", nargs="?", default=25, type=int, help="number of days of the first batch run")
+    parser.add_argument("--ids", default=100, type=int)
+    parser.add_argument("--days", default=45, type=int)
+    parser.add_argument("--models", default="models")
+    args = parser.parse_args()
+    mod = Path(args.models).resolve()
+
+    with tempfile.TemporaryDirectory() as root:
+        raw = Path(root) / "raw" if args.raw is None else Path(args.raw).resolve()
+        if args.raw is None:
+            generate_raw(raw, args.ids, args.days)
+        days = [pd.Timestamp(file.stem) for file in sorted((raw / "intraday_data").glob("*.csv"))]
+        if len(days) <= args.first_days:
+            sys.exit("the raw data should have more days than the first batch run")
+
+        d = DataHandler()
+        p = Preprocessor(d.read_raw(raw, days[0], days[args.first_days - 1], n_jobs=1), mod)
+        p.create_dataset()
+        state = p.create_state()
+        streamer = FeatureStreamer(state, mod)
+
+        batch, stream, latencies = [], [], []
+        for day in days[args.first_days:]:
+            p = Preprocessor(d.read_raw(raw, day, day, n_jobs=1), mod, state)
+            batch.append(p.create_dataset())
+            state = p.create_state()
+            rows, day_latencies = replay_day(streamer, raw, day)
+            stream += rows
+            latencies += day_latencies
+
+    # the last version of each row stored by the batch runs (a row is stored again once its target is complete)
+    batch = pd.concat(batch)
+    batch = batch[~batch.index.duplicated(keep="last")].sort_index()
+    batch = batch[batch.index.get_level_values(1) >= days[args.first_days]]
+    stream = pd.concat(stream).sort_index()
+    common = batch.index.intersection(stream.index)
+    expected, result = batch.loc[common, stream.columns], stream.loc[common]
+    differs = (expected != result) & ~(expected.isna() & result.isna())
+
+    print(f"{len(days) - args.first_days} days replayed: {len(batch)} batch rows, {len(stream)} streamed rows "
+          f"({len(stream.index.difference(batch.index))} without target, {len(batch.index.difference(stream.index))} batch rows not streamed)")
+    print(f"{differs.any(axis=1).sum()} of {len(common)} rows differ")
+    for column, count in differs.sum()[differs.sum() > 0].items():
+        print(f"  {column}: {count} rows")
+    regimes = batch["Market Regime"].groupby(level=1).first()
+    print(f"regimes decoded at the end of the days equal to the batch: {(streamer.regimes.reindex(regimes.index) == regimes).all()}, "
+          f"index returns equal: {streamer.index_returns.equals(state['index_returns'])}")
+    latencies = np.array(latencies) * 1e3
+    print(f"update of a bar: median {np.median(latencies):.2f}ms, p99 {np.percentile(latencies, 99):.2f}ms (15:30 bar with the rows {latencies.max():.2f}ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Generator of synthetic raw data with the schema of the raw files read by DataHandler.read_raw (intraday_data/YYYYMMDD.csv
+and daily_data/dataYYYYMMDD.csv), with missing ticks and ids entering and leaving the universe
+
+usage (from the repository root): python -m benchmarks.synthetic_raw out_path [n_ids] [n_days]
+"""
+import sys
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# ticks of the intraday files (every 15 minutes from 09:45 to 16:00)
+TICKS = pd.timedelta_range("09:45:00", "16:00:00", freq="15min")
+
+
+# writes the raw files of n_ids ids over n_days business days into out
+# about a third of the ids start after the first day or stop before the last one, and 3% of the ticks are missing
+# (the daily data has no missing values: the targets of rows without volatility are not defined)
+def generate_raw(out, n_ids, n_days, start="2015-01-02", seed=0):
+    rng = np.random.default_rng(seed)
+    out = Path(out)
+    (out / "intraday_data").mkdir(parents=True, exist_ok=True)
+    (out / "daily_data").mkdir(parents=True, exist_ok=True)
+    ids = np.arange(1000, 1000 + n_ids)
+    first_day = np.where(rng.random(n_ids) < 1 / 3, rng.integers(0, max(1, n_days // 3), n_ids), 0)
+    last_day = np.where(rng.random(n_ids) < 1 / 3, rng.integers(2 * n_days // 3, n_days + 1, n_ids), n_days)
+    times = np.array([str(tick).split()[-1] for tick in TICKS])
+
+    for day_index, day in enumerate(pd.bdate_range(start, periods=n_days)):
+        alive = ids[(first_day <= day_index) & (day_index < last_day)]
+        returns = rng.normal(0, 0.002, (len(alive), len(TICKS)))
+        volumes = rng.integers(100, 10000, (len(alive), len(TICKS)))
+        keep = (rng.random((len(alive), len(TICKS))) > 0.03).ravel()
+        date = day.strftime("%Y-%m-%d")
+        pd.DataFrame({
+            "Date": date,
+            "Time": np.tile(times, len(alive))[keep],
+            "Id": np.repeat(alive, len(TICKS))[keep],
+            "CumReturnResid": (np.cumprod(1 + returns, axis=1) - 1).ravel()[keep],
+            "CumVolume": np.cumsum(volumes, axis=1).ravel()[keep],
+        }).to_csv(out / "intraday_data" / f"{day:%Y%m%d}.csv", index=False)
+        pd.DataFrame({
+            "Date": date,
+            "ID": alive,
+            "MDV_63": rng.uniform(1e5, 1e7, len(alive)),
+            "EST_VOL": rng.uniform(0.01, 0.03, len(alive)),
+        }).to_csv(out / "daily_data" / f"data{day:%Y%m%d}.csv", index=False)
+
+
+def main():
+    out = Path(sys.argv[1])
+    n_ids = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    n_days = int(sys.argv[3]) if len(sys.argv) > 3 else 60
+    generate_raw(out, n_ids, n_days)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark of Preprocessor.create_target against the former groupby implementation
+
+usage (from the repository root): python -m benchmarks.target [n_days] [n_ids ...]
+"""
+import sys
+import time
+import datetime as dt
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from preprocessing import Preprocessor, CLIP_QUANTILES
+
+
+# generates raw data (as returned by DataHandler.read_raw) of n_ids ids over n_days days, with missing ticks
+def synthetic_raw(n_ids, n_days, seed=0):
+    rng = np.random.default_rng(seed)
+    days = pd.bdate_range("2020-01-02", periods=n_days)
+    ticks = pd.timedelta_range("09:45:00", "16:00:00", freq="15min")
+    returns = rng.normal(0, 2e-3, (n_days, n_ids, len(ticks)))
+    raw_df = pd.DataFrame({
+        "Id": np.tile(np.repeat(np.arange(n_ids), len(ticks)), n_days),
+        "CumReturnResid": (np.cumprod(1 + returns, axis=2) - 1).ravel(),
+        "CumVolume": np.cumsum(rng.integers(100, 10000, returns.shape), axis=2).ravel().astype(float),
+        "MDV_63": np.repeat(rng.uniform(1e5, 1e7, (n_days, n_ids)), len(ticks)),
+        "EST_VOL": np.repeat(rng.uniform(0.01, 0.03, (n_days, n_ids)), len(ticks)),
+    }, index=np.repeat(days.values, n_ids * len(ticks)) + np.tile(ticks.values, n_days * n_ids))
+    raw_df = raw_df[rng.random(len(raw_df)) > 0.03]
+    return raw_df.sort_index(kind="stable")
+
+
+# former implementation: groupby passes over the ticks and merges
+def legacy_target(raw_df):
+    day_sep = raw_df[["Id", "CumReturnResid"]].groupby(["Id", pd.Grouper(level=0, freq="D"), raw_df.index.time>dt.time(15,30)]).last()
+    adj_end = day_sep.add(1).groupby(level=[0, 1]).pct_change().dropna().droplevel(2)
+    begin = day_sep.xs(False, level=2).groupby(level=0).shift(-1)
+    joined = adj_end.merge(begin, how="inner", left_index=True, right_index=True)
+    target = joined.stack().add(1).groupby(level=[0, 1]).prod().sub(1).rename("Target").to_frame()
+    est_vol = raw_df[["Id", "EST_VOL"]].groupby(["Id", pd.Grouper(level=0, freq="D")]).first()
+    target_vol = target.merge(est_vol, how="left", left_index=True, right_index=True)
+    target = (target_vol["Target"] / target_vol["EST_VOL"]).rename("Target")
+    return target.clip(lower=target.quantile(CLIP_QUANTILES[0]), upper=target.quantile(CLIP_QUANTILES[1]))
+
+
+def main():
+    n_days = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    universe_sizes = [int(n) for n in sys.argv[2:]] or [500, 2000, 5000]
+
+    for n_ids in universe_sizes:
+        raw_df = synthetic_raw(n_ids, n_days)
+
+        start = time.perf_counter()
+        expected = legacy_target(raw_df)
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        result = Preprocessor(raw_df, Path("models")).create_target()
+        sorted_time = time.perf_counter() - start
+
+        pd.testing.assert_series_equal(result, expected, check_exact=True)
+        print(f"{n_ids} ids x {n_days} days ({len(raw_df)} ticks): groupby {legacy_time:.2f}s, single sort {sorted_time:.2f}s, speedup x{legacy_time / sorted_time:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+import json
+import math
+import pickle
+import argparse
+from pathlib import Path
+import numpy as np
+
+from preprocessing import load_hmm_models
+from stagecache import files_fingerprint
+
+# the artifact is the magic bytes, the length of the json header (8 bytes) and the header, followed by the arrays
+# (aligned so that they can be viewed in place from the memory mapped file)
+_MAGIC = b"LGBHMM01"
+_ALIGNMENT = 64
+# missing value handling of the numerical splits (as lightgbm)
+_MISSING_TYPES = {"None": 0, "Zero": 1, "NaN": 2}
+_MISSING_ZERO, _MISSING_NAN = 1, 2
+# lightgbm treats the values closer to 0 than this as 0
+_ZERO_THRESHOLD = float(np.float32(1e-35))
+
+
+# files of the models of a models path the artifact is built from
+def _model_files(mod):
+    return [(mod / "lgb_model1.pkl").resolve()] + sorted((mod / "HMM").resolve().glob("*.pkl"))
+
+
+# compiles the lightgbm model and the hmm ensemble of the models path into a single artifact at path
+# (with the fingerprint of the model files, see CompiledModels)
+def compile_models(mod, path):
+    with open((mod / "lgb_model1.pkl").resolve(), "rb") as file:
+        model = pickle.load(file)
+    arrays, header = _compile_trees(model.booster_.dump_model())
+    hmm_arrays, hmm_header = _compile_hmms(load_hmm_models(mod))
+    arrays.update(hmm_arrays)
+    header.update(hmm_header)
+    header["sources"] = files_fingerprint(_model_files(mod))
+    _write_artifact(path, arrays, header)
+
+
+# flattens the trees into arrays of nodes: the children of a node are nodes (>= 0) or leaves (~leaf < 0)
+def _compile_trees(dump):
+    if dump["objective"].split()[0] != "regression" or dump["num_tree_per_iteration"] != 1:
+        raise ValueError("only regression models (without output transformation) can be compiled")
+    nodes = {"feature": [], "threshold": [], "left": [], "right": [], "default_left": [], "missing": [], "categorical": []}
+    leaf_values, roots, categories = [], [], []
+
+    def add(tree):
+        if "leaf_value" in tree:
+            leaf_values.append(tree["leaf_value"])
+            return ~(len(leaf_values) - 1)
+        node = len(nodes["feature"])
+        for values in nodes.values():
+            values.append(0)
+        nodes["feature"][node] = tree["split_feature"]
+        nodes["default_left"][node] = tree["default_left"]
+        nodes["missing"][node] = _MISSING_TYPES[tree["missing_type"]]
+        if tree["decision_type"] == "==":
+            # the threshold of a categorical split is the row of its categories
+            nodes["categorical"][node] = 1
+            nodes["threshold"][node] = len(categories)
+            categories.append([int(category) for category in str(tree["threshold"]).split("||")])
+        else:
+            nodes["threshold"][node] = tree["threshold"]
+        nodes["left"][node] = add(tree["left_child"])
+        nodes["right"][node] = add(tree["right_child"])
+        return node
+
+    for tree in dump["tree_info"]:
+        roots.append(add(tree["tree_structure"]))
+
+    # categories going left as bitsets of 32 bits words (as lightgbm)
+    words = max([max(row) // 32 + 1 for row in categories], default=1)
+    bitsets = np.zeros((max(len(categories), 1), words), dtype=np.uint32)
+    for row, values in enumerate(categories):
+        for category in values:
+            bitsets[row, category // 32] |= np.uint32(1 << (category % 32))
+
+    arrays = {
+        "tree_root": np.array(roots, dtype=np.int32),
+        "node_feature": np.array(nodes["feature"], dtype=np.int32),
+        "node_threshold": np.array(nodes["threshold"], dtype=np.float64),
+        "node_left": np.array(nodes["left"], dtype=np.int32),
+        "node_right": np.array(nodes["right"], dtype=np.int32),
+        "node_default_left": np.array(nodes["default_left"], dtype=np.bool_),
+        "node_missing": np.array(nodes["missing"], dtype=np.uint8),
+        "node_categorical": np.array(nodes["categorical"], dtype=np.bool_),
+        "leaf_value": np.array(leaf_values, dtype=np.float64),
+        "category_bitsets": bitsets,
+    }
+    header = {"feature_names": dump["feature_names"], "pandas_categorical": dump["pandas_categorical"]}
+    return arrays, header
+
+
+# stacks the viterbi parameters of the hmm models: the logarithms of the start and transition probabilities and the
+# gaussian emissions (means, covariances and the normalisation term of the log density)
+def _compile_hmms(hmm_models):
+    for model in hmm_models:
+        if model.covariance_type != "diag" or model.algorithm != "viterbi" or model.n_components != hmm_models[0].n_components:
+            raise ValueError("only viterbi decoding of diagonal gaussian hmms with the same number of states can be compiled")
+    # same computations as hmmlearn (its viterbi takes the logarithms with the c library, like math.log)
+    covars = np.stack([np.maximum(model._covars_, np.finfo(float).tiny) for model in hmm_models])
+    arrays = {
+        "hmm_log_startprob": np.stack([_log(model.startprob_) for model in hmm_models]),
+        "hmm_log_transmat": np.stack([_log(model.transmat_) for model in hmm_models]),
+        "hmm_means": np.stack([model.means_ for model in hmm_models]),
+        "hmm_covars": covars,
+        "hmm_log_norm": covars.shape[-1] * np.log(2 * np.pi) + np.log(covars).sum(axis=-1),
+    }
+    return arrays, {"hmm_models": len(hmm_models)}
+
+
+def _log(probabilities):
+    return np.vectorize(lambda p: math.log(p) if p > 0 else -np.inf, otypes=[np.float64])(probabilities)
+
+
+def _write_artifact(path, arrays, header):
+    header = dict(header, arrays={})
+    offset = 0
+    for name, values in arrays.items():
+        header["arrays"][name] = {"dtype": values.dtype.str, "shape": values.shape, "offset": offset}
+        offset += -(-values.nbytes // _ALIGNMENT) * _ALIGNMENT
+    encoded = json.dumps(header).encode()
+    start = -(-(len(_MAGIC) + 8 + len(encoded)) // _ALIGNMENT) * _ALIGNMENT
+    # written under another name first so that a running server never maps a partial file
+    temporary = path.with_suffix(path.suffix + ".tmp")
+    with open(temporary, "wb") as file:
+        file.write(_MAGIC + len(encoded).to_bytes(8, "little") + encoded)
+        for name, values in arrays.items():
+            file.seek(start + header["arrays"][name]["offset"])
+            file.write(np.ascontiguousarray(values).tobytes())
+        file.truncate(start + offset)
+    temporary.replace(path)
+
+
+class CompiledModels:
+    """
+    Compiled lightgbm model and hmm ensemble (see compile_models) evaluated with numpy on arrays mapped from the artifact
+    the artifact maps at once and its viterbi decodes all the hmm models together, but its trees are slower than
+    lightgbm (see benchmarks/compiled_latency.py): the rows are predicted by lightgbm, predict is a portable reference
+    """
+    # with mod, the artifact has to be built from the current model files of mod (a stale artifact raises an error)
+    def __init__(self, path, mod=None):
+        self._buffer = np.memmap(path, dtype=np.uint8, mode="r")
+        if bytes(self._buffer[:len(_MAGIC)]) != _MAGIC:
+            raise ValueError(f"{path} is not a compiled models file")
+        length = int.from_bytes(bytes(self._buffer[len(_MAGIC):len(_MAGIC) + 8]), "little")
+        header = json.loads(bytes(self._buffer[len(_MAGIC) + 8:len(_MAGIC) + 8 + length]))
+        start = -(-(len(_MAGIC) + 8 + length) // _ALIGNMENT) * _ALIGNMENT
+        self._arrays = {}
+        for name, info in header.pop("arrays").items():
+            dtype, shape = np.dtype(info["dtype"]), tuple(info["shape"])
+            offset = start + info["offset"]
+            self._arrays[name] = self._buffer[offset:offset + dtype.itemsize * math.prod(shape)].view(dtype).reshape(shape)
+        self.feature_names = header["feature_names"]
+        self.pandas_categorical = header["pandas_categorical"]
+        if mod is not None and header.get("sources") != files_fingerprint(_model_files(mod)):
+            raise ValueError(f"{path} was not compiled from the current models of {mod}, compile them again")
+
+    # raw prediction of the model for each row of features (the same as Booster.predict)
+    def predict(self, features):
+        a = self._arrays
+        features = np.asarray(features, dtype=np.float64).reshape(-1, len(self.feature_names))
+        # lightgbm reads the values closer to 0 than its threshold as 0
+        features = np.where(np.abs(features) <= _ZERO_THRESHOLD, 0.0, features)
+        n_trees = len(a["tree_root"])
+        # the rows go down all the trees at once, a level at a time
+        nodes = np.tile(a["tree_root"], len(features))
+        rows = np.repeat(np.arange(len(features)), n_trees)
+        pending = np.flatnonzero(nodes >= 0)
+        while len(pending):
+            node = nodes[pending]
+            left = self._goes_left(node, features[rows[pending], a["node_feature"][node]])
+            nodes[pending] = np.where(left, a["node_left"][node], a["node_right"][node])
+            pending = pending[nodes[pending] >= 0]
+        # summing the trees in order (as lightgbm)
+        leaves = a["leaf_value"][~nodes].reshape(len(features), n_trees)
+        return np.add.accumulate(leaves, axis=1)[:, -1] if n_trees else np.zeros(len(features))
+
+    # decision of the nodes for their values (see the numerical and categorical decisions of lightgbm trees)
+    def _goes_left(self, node, values):
+        a = self._arrays
+        missing = a["node_missing"][node]
+        is_nan = np.isnan(values)
+        numerical = np.where(is_nan & (missing != _MISSING_NAN), 0.0, values)
+        default = ((missing == _MISSING_ZERO) & (np.abs(numerical) <= _ZERO_THRESHOLD)) | ((missing == _MISSING_NAN) & is_nan)
+        left = np.where(default, a["node_default_left"][node], numerical <= a["node_threshold"][node])
+        categorical = np.flatnonzero(a["node_categorical"][node])
+        if len(categorical):
+            # the categories are the values cast to int, nan and negative values going right
+            values = values[categorical]
+            valid = ~np.isnan(values) & (values > -1) & (values < 2**31)
+            categories = np.where(valid, values, 0).astype(np.int64)
+            bitsets = a["category_bitsets"][a["node_threshold"][node[categorical]].astype(np.int64)]
+            words = categories // 32
+            valid &= words < bitsets.shape[1]
+            bits = bitsets[np.arange(len(categories)), np.minimum(words, bitsets.shape[1] - 1)] >> (categories % 32).astype(np.uint32)
+            left[categorical] = valid & (bits & 1).astype(bool)
+        return left
+
+    # regimes of the index returns decoded by every hmm model (viterbi) and voted (the most frequent, the lowest on ties),
+    # the same as preprocessing.predict_regimes
+    def predict_regimes(self, index_returns):
+        a = self._arrays
+        means, covars = a["hmm_means"], a["hmm_covars"]
+        X = np.asarray(index_returns, dtype=float).reshape(-1, means.shape[-1])
+        n_models, n_states = a["hmm_log_startprob"].shape
+        # log likelihood of the emissions of every model (models x samples x states)
+        log_frameprob = -0.5 * (a["hmm_log_norm"][:, None, :] + ((X[None, :, None, :] - means[:, None, :, :]) ** 2 / covars[:, None, :, :]).sum(axis=-1))
+        lattice = np.empty((len(X), n_models, n_states))
+        lattice[0] = a["hmm_log_startprob"] + log_frameprob[:, 0]
+        for t in range(1, len(X)):
+            lattice[t] = np.fmax.reduce(lattice[t - 1][:, :, None] + a["hmm_log_transmat"], axis=1, initial=-np.inf) + log_frameprob[:, t]
+        # traceback (on ties, the last state is the first best one and the previous states the last best ones)
+        states = np.empty((len(X), n_models), dtype=np.int64)
+        states[-1] = np.argmax(lattice[-1], axis=1)
+        models = np.arange(n_models)
+        for t in range(len(X) - 2, -1, -1):
+            work = lattice[t] + a["hmm_log_transmat"][models, :, states[t + 1]]
+            states[t] = n_states - 1 - np.argmax(work[:, ::-1], axis=1)
+        votes = (states[:, :, None] == np.arange(n_states)).sum(axis=1)
+        return np.argmax(votes, axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', required=True, help="models path")
+    parser.add_argument('-o', help="compiled models file (compiled.bin in the models path by default)")
+    args = parser.parse_args()
+
+    mod = (Path.cwd() / args.p).resolve()
+    path = mod / "compiled.bin" if args.o is None else (Path.cwd() / args.o).resolve()
+    compile_models(mod, path)
+    print(f"compiled models written to {path}")
+
+
+if __name__ == "__main__":
+    main()
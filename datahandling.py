@@ -1,61 +1,320 @@
+import os
+import pickle
+import numpy as np
 import pandas as pd
 from pathlib import Path
 from datetime import datetime as dt, time
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from profiling import stage
+from featurestore import FeatureStore
+from stagecache import fingerprint, files_fingerprint
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# columns of the raw files that are used by the pipeline and their types
+INTRADAY_COLUMNS = ["Date", "Time", "Id", "CumReturnResid", "CumVolume"]
+DAILY_COLUMNS = ["Date", "ID", "MDV_63", "EST_VOL"]
+RAW_DTYPES = {"Time": "str", "CumReturnResid": "float64", "CumVolume": "float64", "MDV_63": "float64", "EST_VOL": "float64"}
+# columns kept in float64 in compact mode (returns are computed from differences of the cumulative return)
+COMPACT_FLOAT64_COLUMNS = ["CumReturnResid"]
+
+
+# gets the shard of each id when the ids are split into n_shards (the same in every process, unlike hash())
+def shard_of(ids, n_shards):
+    return pd.util.hash_array(np.asarray(ids)) % n_shards
+
+
+# reads a single raw csv file (module level so that it can be sent to worker processes)
+# with shard (index, number of shards), only the rows of the ids of that shard are kept
+def _read_raw_file(file, usecols, cache=None, compact=False, shard=None):
+    if shard is None:
+        data = _read_cached(file, usecols, cache)
+    else:
+        data = _read_shard(file, usecols, cache, *shard)
+
+    if "Time" in data.columns:
+        data["Time"] = pd.to_timedelta(data["Time"])
+    if compact:
+        for col in data.columns.intersection(RAW_DTYPES).difference(["Time"] + COMPACT_FLOAT64_COLUMNS):
+            data[col] = data[col].astype("float32")
+    return data
+
+
+def _read_cached(file, usecols, cache=None):
+    # using the columnar copy of the file if it is up to date
+    if cache is not None:
+        cached = (cache / f"{file.stem}.parquet").resolve()
+        data = _read_fresh(cached, file)
+        if data is not None:
+            return data
+    data = pd.read_csv(file, usecols=usecols, parse_dates=["Date"], dtype={col: RAW_DTYPES[col] for col in usecols if col in RAW_DTYPES})
+
+    # storing the columnar copy (one file per date)
+    if cache is not None:
+        cache.mkdir(parents=True, exist_ok=True)
+        _write_cached(cached, data)
+    return data
+
+
+# with a cache, the file is also split into a columnar copy per shard the first time one of its shards is read
+# so that the other shards do not read the whole file again
+def _read_shard(file, usecols, cache, index, n_shards):
+    shard_file = None if cache is None else (cache / f"shards{n_shards}" / str(index) / f"{file.stem}.parquet").resolve()
+    if shard_file is not None:
+        data = _read_fresh(shard_file, file)
+        if data is not None:
+            return data
+    data = _read_cached(file, usecols, cache)
+    shards = shard_of(data["Id"] if "Id" in data.columns else data["ID"], n_shards)
+    if cache is not None:
+        for k in range(n_shards):
+            path = (cache / f"shards{n_shards}" / str(k) / f"{file.stem}.parquet").resolve()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            _write_cached(path, data[shards == k])
+    return data[shards == index].reset_index(drop=True)
+
+
+# reads the columnar copy of file if it is up to date (None if it is not, or if it cannot be read, the file then being
+# parsed again)
+def _read_fresh(cached, file):
+    if not _is_fresh(cached, file):
+        return None
+    try:
+        return pd.read_parquet(cached)
+    except (OSError, pa.ArrowException):
+        return None
+
+
+# written under another name first as other processes may be reading the same file
+def _write_cached(path, data):
+    temporary = path.with_suffix(f".{os.getpid()}.tmp")
+    data.to_parquet(temporary, index=False)
+    os.replace(temporary, path)
+
+
+def _is_fresh(cached, file):
+    return cached.exists() and cached.stat().st_mtime >= file.stat().st_mtime
+
+class CsvStorage:
+    """
+    Storage of the processed data as csv files (the index is stored as the first two unnamed columns)
+    """
+    extension = "csv"
+
+    # reading the rows of the files (indexed by Id and Date), with only the given columns if set
+    # (the files being daily, the dates are already selected by the files)
+    def read(self, files, start=None, end=None, columns=None):
+        usecols = None if columns is None else lambda column: column.startswith("Unnamed") or column in columns
+        return pd.concat([self._read_file(file, usecols) for file in files])
+
+    # reading a whole file back without any rounding (to update it)
+    def read_file(self, path):
+        return self._read_file(path, float_precision="round_trip")
+
+    def _read_file(self, file, usecols=None, float_precision=None):
+        return pd.read_csv(file, usecols=usecols, parse_dates=[1], float_precision=float_precision).rename(columns={"Unnamed: 0": "Id", "Unnamed: 1": "Date"}).set_index(["Id", "Date"])
+
+    def write(self, path, data):
+        data.to_csv(path)
+
+    # writer of data to path by parts (see DataHandler.store_prediction_batches)
+    def writer(self, path):
+        return _CsvWriter(path)
+
+
+class ParquetStorage:
+    """
+    Storage of the processed data as parquet files: dtypes are kept and all the files are read at once by arrow,
+    which only reads the columns asked for and skips the row groups outside of the dates asked for
+    """
+    extension = "parquet"
+
+    def read(self, files, start=None, end=None, columns=None):
+        if columns is not None:
+            columns = ["Id", "Date"] + [column for column in columns if column not in ("Id", "Date")]
+        # pushing the date range down to the reader
+        condition = None
+        if start is not None:
+            condition = ds.field("Date") >= pa.scalar(pd.Timestamp(start), pa.timestamp("ns"))
+        if end is not None:
+            before = ds.field("Date") <= pa.scalar(pd.Timestamp(end), pa.timestamp("ns"))
+            condition = before if condition is None else condition & before
+        table = ds.dataset([str(file) for file in files], format=self.extension).to_table(columns=columns, filter=condition)
+        return table.to_pandas().set_index(["Id", "Date"])
+
+    def read_file(self, path):
+        return self.read([path])
+
+    # the index is stored as Id and Date columns (or a Date column for the predictions)
+    def write(self, path, data):
+        self._write_frame(self._frame(data), path)
+
+    def writer(self, path):
+        return _ArrowWriter(path, pq.ParquetWriter, self._frame)
+
+    def _frame(self, data):
+        return data.rename_axis(["Id", "Date"] if data.index.nlevels == 2 else ["Date"]).reset_index()
+
+    def _write_frame(self, data, path):
+        data.to_parquet(path, index=False)
+
+
+class FeatherStorage(ParquetStorage):
+    """
+    Storage of the processed data as feather (arrow ipc) files, larger than parquet files but faster to read
+    """
+    extension = "feather"
+
+    def writer(self, path):
+        # compressed as pandas compresses feather files
+        return _ArrowWriter(path, lambda path, schema: pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(compression="lz4")), self._frame)
+
+    def _write_frame(self, data, path):
+        data.to_feather(path)
+
+
+class _CsvWriter:
+    """
+    Writer of data to a csv file by parts (the header is written with the first part)
+    """
+    def __init__(self, path):
+        self._file = open(path, "w", newline="")
+        self._header = True
+
+    def write(self, data):
+        data.to_csv(self._file, header=self._header)
+        self._header = False
+
+    def close(self):
+        self._file.close()
+
+
+class _ArrowWriter:
+    """
+    Writer of data to an arrow based file by parts (the file is created with the schema of the first part)
+    """
+    def __init__(self, path, new_writer, frame):
+        self._path = path
+        self._new_writer = new_writer
+        self._frame = frame
+        self._writer = None
+
+    def write(self, data):
+        table = pa.Table.from_pandas(self._frame(data), preserve_index=False)
+        if self._writer is None:
+            self._writer = self._new_writer(str(self._path), table.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+class MemmapStorage(FeatherStorage):
+    """
+    Storage of the processed data as a memory mapped feature store (see featurestore.FeatureStore) that is read by
+    date range and Ids without parsing whole days, the predictions being stored as feather files
+    """
+
+
+# storages of the processed data by name
+STORAGES = {"csv": CsvStorage, "parquet": ParquetStorage, "feather": FeatherStorage, "memmap": MemmapStorage}
+
 
 class DataHandler:
     """
     Datahandling class that gets the data and formats it
     """
+    # storage is the format of the processed data and the predictions (name of STORAGES or storage object)
+    # with a profiler (see profiling.Profiler), the reads and writes are recorded as stages
+    def __init__(self, storage="csv", profiler=None):
+        self._storage = STORAGES[storage]() if isinstance(storage, str) else storage
+        self._profiler = profiler
     
     # gets the raw daily data and concatenates it into a single dataframe
-    def read_raw(self, loc, start=None, end=None):
+    # files are read concurrently by n_jobs processes (all cores if None) and, if cache is set,
+    # a parquet copy of every file is kept there so that later runs skip csv parsing
+    # in compact mode, ids are categorical and the columns that allow it are float32
+    # with shard (index, number of shards), only the ids of that shard are kept (see shard_of)
+    def read_raw(self, loc, start=None, end=None, n_jobs=None, cache=None, compact=False, shard=None):
+        with stage(self._profiler, "read_raw") as record:
+            data = self._read_raw(loc, start, end, n_jobs, cache, compact, shard)
+            record["rows"] = len(data)
+        return data
+
+    # fingerprint of the files read by read_raw with the same arguments (the results of the preprocessing stages are
+    # cached by it, see Preprocessor and stagecache)
+    def raw_fingerprint(self, loc, start=None, end=None, compact=False, shard=None):
+        intraday_files, daily_files = self._raw_files(loc, start, end)
+        return fingerprint(files_fingerprint(intraday_files + daily_files), compact, shard)
+
+    def _read_raw(self, loc, start, end, n_jobs, cache, compact, shard):
+        if n_jobs is None:
+            n_jobs = os.cpu_count()
+
+        intraday_files, daily_files = self._raw_files(loc, start, end)
+
+        intraday_cache = None if cache is None else cache / "intraday_data"
+        daily_cache = None if cache is None else cache / "daily_data"
+        tasks = [(file, INTRADAY_COLUMNS, intraday_cache, compact, shard) for file in intraday_files] + [(file, DAILY_COLUMNS, daily_cache, compact, shard) for file in daily_files]
+
+        # reading all the files (keeping the order of the files)
+        if n_jobs > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=min(n_jobs, len(tasks))) as executor:
+                frames = list(executor.map(_read_raw_file, *zip(*tasks), chunksize=max(1, len(tasks) // (4 * n_jobs))))
+        else:
+            frames = [_read_raw_file(*task) for task in tasks]
+
+        intraday_data = pd.concat(frames[:len(intraday_files)])
+        daily_data = pd.concat(frames[len(intraday_files):])
+
+        # merging intraday with daily data                              
+        data = intraday_data.merge(daily_data, how="left", left_on=["Date", "Id"], right_on=["Date", "ID"])
+        
+        # setting index as datetime index
+        data.index = data['Date'] + data['Time']
         
+        data.drop(["ID", "Date", "Time"], axis=1, inplace=True)
+        if compact:
+            data["Id"] = data["Id"].astype("category")
+                                      
+        data = data.sort_index()
+        return data
+
+    # gets the intraday and daily files between start and end
+    def _raw_files(self, loc, start, end):
         # gets min and max timestamps if no data
         if start is None:
             start = pd.Timestamp.min
             
         if end is None:
             end = pd.Timestamp.max
-            
-        # getting intraday data
-        intraday_data_list = []
-        for file in sorted((loc / "intraday_data").resolve().glob("*.csv")):
-            
-            # checking if date of file is between start and end
-            file_date = self._intraday_file2date(file)
-            if file_date < start:
-                continue
-            if file_date > end:
-                break
-            
-            intraday_data_list.append(pd.read_csv(file, parse_dates =["Date"]))
-            
-        intraday_data = pd.concat(intraday_data_list)
-        
-        # getting daily_data
-        daily_data_list = []
-        for file in sorted((loc / "daily_data").resolve().glob("*.csv")):
+
+        intraday_files = self._files_between(loc / "intraday_data", self._intraday_file2date, start, end)
+        daily_files = self._files_between(loc / "daily_data", self._daily_file2date, start, end)
+        return intraday_files, daily_files
+
+    # gets the days of the raw intraday files between start and end
+    def raw_days(self, loc, start=None, end=None):
+        files = self._files_between(loc / "intraday_data", self._intraday_file2date, start or pd.Timestamp.min, end or pd.Timestamp.max)
+        return pd.DatetimeIndex([self._intraday_file2date(file) for file in files])
+
+    # gets the sorted files of a directory whose date is between start and end
+    def _files_between(self, loc, file2date, start, end):
+        files = []
+        for file in sorted(loc.resolve().glob("*.csv")):
             
             # checking if date of file is between start and end
-            file_date = self._daily_file2date(file)
+            file_date = file2date(file)
             if file_date < start:
                 continue
             if file_date > end:
                 break
-                
-            daily_data_list.append(pd.read_csv(file, parse_dates =["Date"]))#, usecols=daily_cols))
-            
-        daily_data = pd.concat(daily_data_list)
 
-        # merging intraday with daily data                              
-        data = intraday_data.merge(daily_data, how="left", left_on=["Date", "Id"], right_on=["Date", "ID"])
-        
-        # setting index as datetime index
-        data.index = data['Date'] + pd.to_timedelta(data['Time'])
-        
-        data.drop(["ID", "Date", "Time"], axis=1, inplace=True)
-                                      
-        return data.sort_index()
+            files.append(file)
+        return files
     
     # functions to translate file name to datetime
     def _intraday_file2date(self, file):
@@ -64,8 +323,42 @@ class DataHandler:
     def _daily_file2date(self, file):
         return pd.to_datetime(file.stem[4:])
     
-    # function to read processed data
-    def read_processed(self, loc, start=None, end=None):
+    # function to read processed data (with columns, only these features are read, and with ids, only these ids)
+    # the data is read from the feature store of loc if it has one (see featurestore.FeatureStore) whatever the storage
+    def read_processed(self, loc, start=None, end=None, columns=None, ids=None):
+        if FeatureStore.exists(loc):
+            store = FeatureStore(loc)
+            days = self._store_days(store, start, end)
+            return self._read_processed(partial(store.read, days[0], days[-1], ids), columns)
+        start, end, files = self._processed_files(loc, start, end)
+        return self._read_processed(partial(self._storage.read, files, start, end), columns, ids)
+
+    # reads the processed data by batches of batch_days days (date files), yielding X, y, weights of each batch
+    # so that only one batch is in memory at a time
+    def read_processed_batches(self, loc, start=None, end=None, columns=None, batch_days=1, ids=None):
+        if FeatureStore.exists(loc):
+            store = FeatureStore(loc)
+            days = self._store_days(store, start, end)
+            for first in range(0, len(days), batch_days):
+                yield self._read_processed(partial(store.read, days[first], days[min(first + batch_days, len(days)) - 1], ids), columns)
+            return
+        start, end, files = self._processed_files(loc, start, end)
+        for first in range(0, len(files), batch_days):
+            yield self._read_processed(partial(self._storage.read, files[first:first + batch_days], start, end), columns, ids)
+
+    # gets the days of the processed data between start and end (the days of its feature store or of its date files)
+    def processed_days(self, loc, start=None, end=None):
+        if FeatureStore.exists(loc):
+            return pd.DatetimeIndex(self._store_days(FeatureStore(loc), start, end))
+        return pd.DatetimeIndex([self._processed_file2date(file) for file in self._processed_files(loc, start, end)[2]])
+
+    def _store_days(self, store, start, end):
+        days = store.days_between(start, end)
+        if len(days) == 0:
+            raise ValueError("feature store has no days in date interval")
+        return days
+
+    def _processed_files(self, loc, start, end):
 
          # gets min and max timestamps if no data
         if start is None:
@@ -74,22 +367,33 @@ class DataHandler:
         if end is None:
             end = pd.Timestamp.max
         
-        # getting daily_data
-        daily_data_list = []
-        for file in sorted(loc.glob("*.csv")):
+        # getting the daily files between start and end
+        files = []
+        for file in sorted(loc.glob(f"*.{self._storage.extension}")):
             
             file_date = self._processed_file2date(file)
             if file_date < start:
                 continue
             if file_date > end:
                 break
-            # getting Market Regime as category and renaming the multiindex and setting it again
-            daily_data_list.append(pd.read_csv(file, parse_dates =[1], dtype={"Market Regime":"category"}).rename(columns={"Unnamed: 0": "Id", "Unnamed: 1": "Date"}).set_index(["Id", "Date"]))
+            files.append(file)
 
-        if len(daily_data_list) == 0:
-            raise ValueError("features path has no csv files or no files in date interval")
-        
-        daily_data = pd.concat(daily_data_list).sort_index()
+        if len(files) == 0:
+            raise ValueError(f"features path has no {self._storage.extension} files or no files in date interval")
+        return start, end, files
+
+    # read is given the columns to read (all if None) and returns the rows indexed by Id and Date (only the rows of ids
+    # are kept if set)
+    def _read_processed(self, read, columns, ids=None):
+        with stage(self._profiler, "read_processed") as record:
+            daily_data = read(None if columns is None else list(columns) + ["Sample Weights", "Target"])
+            if ids is not None:
+                daily_data = daily_data[daily_data.index.get_level_values(0).isin(ids)]
+            daily_data = daily_data.sort_index()
+            # getting Market Regime as category (of the regime numbers)
+            if "Market Regime" in daily_data.columns:
+                daily_data["Market Regime"] = daily_data["Market Regime"].astype("category")
+            record["rows"] = len(daily_data)
 
         # returning X, y, weights
         return daily_data.drop(["Sample Weights", "Target"], axis=1), daily_data["Target"], daily_data["Sample Weights"]
@@ -99,16 +403,65 @@ class DataHandler:
         return pd.to_datetime(file.stem)
     
     # storing the processed data to daily files
-    def store_dataset(self, out, dataset):
-        for day, daily_data in dataset.groupby(level=1):
-            path = (out / f"{dt.strftime(day, '%Y-%m-%d')}.csv").resolve()
-            daily_data.to_csv(path)
+    # with update, the rows of days that are already stored replace the stored ones (the other rows are kept)
+    def store_dataset(self, out, dataset, update=False):
+        with stage(self._profiler, "store_dataset") as record:
+            record["rows"] = len(dataset)
+            if isinstance(self._storage, MemmapStorage):
+                FeatureStore(out).append(dataset, update=update)
+                return
+            for day, daily_data in dataset.groupby(level=1):
+                self._store_day(out, day, daily_data, update)
+
+    # storing the processed data given as the rows of each day (e.g. by ShardedPreprocessor.create_days), one day at a time
+    def store_days(self, out, days, update=False):
+        with stage(self._profiler, "store_dataset") as record:
+            record["rows"] = 0
+            store = FeatureStore(out) if isinstance(self._storage, MemmapStorage) else None
+            for daily_data in days:
+                if store is not None:
+                    store.append(daily_data, update=update)
+                else:
+                    self._store_day(out, daily_data.index.get_level_values(1)[0], daily_data, update)
+                record["rows"] += len(daily_data)
+
+    def _store_day(self, out, day, daily_data, update):
+        path = (out / f"{dt.strftime(day, '%Y-%m-%d')}.{self._storage.extension}").resolve()
+        if update and path.exists():
+            stored = self._storage.read_file(path)
+            stored.index.names = daily_data.index.names
+            daily_data = pd.concat([stored[~stored.index.isin(daily_data.index)], daily_data]).sort_index()
+        self._storage.write(path, daily_data)
+
+    # reading and storing the state of the preprocessing used by incremental runs
+    def read_state(self, path):
+        with open(path, "rb") as file:
+            return pickle.load(file)
+
+    def store_state(self, path, state):
+        with open(path, "wb") as file:
+            pickle.dump(state, file)
 
     # storing the predictions
     def store_predictions(self, out, y_preds, y):
-        predictions_df = pd.DataFrame(y_preds, index=y.index, columns=["Pred"]).reset_index(0)
+        self.store_prediction_batches(out, [(y_preds, y)])
+
+    # storing the predictions of batches of rows (pairs of predictions and targets) to the same file as they come
+    def store_prediction_batches(self, out, batches):
+        writer = self._storage.writer((out / f"predictions.{self._storage.extension}").resolve())
+        try:
+            for y_preds, y in batches:
+                with stage(self._profiler, "store_predictions") as record:
+                    writer.write(self.format_predictions(y_preds, y.index))
+                    record["rows"] = len(y_preds)
+        finally:
+            writer.close()
+
+    # formatting the predictions of the (Id, Date) rows as they are stored
+    def format_predictions(self, y_preds, index):
+        predictions_df = pd.DataFrame(y_preds, index=index, columns=["Pred"]).reset_index(0)
         predictions_df["Time"] = time(15, 30)
-        predictions_df[['Time', 'Id', 'Pred']].to_csv((out / "predictions.csv").resolve())
+        return predictions_df[['Time', 'Id', 'Pred']]
 
 
         
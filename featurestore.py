@@ -0,0 +1,156 @@
+import os
+import pickle
+import numpy as np
+import pandas as pd
+
+# file of the index of the store (columns, days and the offset of the first row of every day)
+INDEX_FILE = "index.pkl"
+
+
+class FeatureStore:
+    """
+    Store of the processed data (as returned by create_dataset) as memory mapped numpy column files
+    the rows are sorted by date then Id, so that the rows of a date range are a contiguous slice of every column and
+    the rows of Ids are found by binary search in the Ids of each day; new days are appended to the column files
+    appending rewrites the column files in place from the first day of the dataset (usually the last stored day): there
+    should be only one writer and no open reader while appending (the stores opened before, and the columns they
+    returned, are invalid afterwards and have to be opened again)
+    """
+    def __init__(self, path):
+        self._path = path
+        self._maps = {}
+        if self.exists(path):
+            with open(path / INDEX_FILE, "rb") as file:
+                self._index = pickle.load(file)
+        else:
+            self._index = {"columns": [], "dtypes": [], "id_dtype": None, "days": np.array([], dtype="datetime64[ns]"), "day_offsets": np.zeros(1, dtype=np.int64)}
+
+    @staticmethod
+    def exists(path):
+        return (path / INDEX_FILE).exists()
+
+    @property
+    def columns(self):
+        return list(self._index["columns"])
+
+    @property
+    def days(self):
+        return self._index["days"]
+
+    def __len__(self):
+        return int(self._index["day_offsets"][-1])
+
+    # rows of the dates between start and end (included) as a slice, or as positions with only the rows of the ids
+    def rows(self, start=None, end=None, ids=None):
+        first, last = self._days_between(start, end)
+        offsets = self._index["day_offsets"]
+        if ids is None:
+            return slice(int(offsets[first]), int(offsets[last]))
+        wanted = np.unique(np.asarray(ids))
+        store_ids = self._map("ids")
+        positions = []
+        for day in range(first, last):
+            day_ids = store_ids[offsets[day]:offsets[day + 1]]
+            found = np.searchsorted(day_ids, wanted).clip(max=max(len(day_ids) - 1, 0))
+            positions.append(offsets[day] + found[day_ids[found] == wanted] if len(day_ids) else found[:0])
+        return np.concatenate(positions) if positions else np.array([], dtype=np.int64)
+
+    # values of a column for the rows (see rows), a view of the mapped file when no ids are given
+    def column(self, name, start=None, end=None, ids=None):
+        return self._column(name)[self.rows(start, end, ids)]
+
+    # frame indexed by (Id, Date) of the rows (see rows), with only the given columns if set
+    def read(self, start=None, end=None, ids=None, columns=None):
+        rows = self.rows(start, end, ids)
+        offsets = self._index["day_offsets"]
+        dates = np.repeat(self._index["days"], np.diff(offsets))[rows]
+        index = pd.MultiIndex.from_arrays([self._map("ids")[rows], dates], names=["Id", "Date"])
+        columns = self._index["columns"] if columns is None else columns
+        return pd.DataFrame({name: self._column(name)[rows] for name in columns}, index=index, columns=columns)
+
+    # whole mapped column
+    def _column(self, name):
+        if name not in self._index["columns"]:
+            raise ValueError(f"column {name} is not in the feature store")
+        return self._map(self._index["columns"].index(name))
+
+    # appends the rows of the dataset (indexed by (Id, Date)) to the store, only the stored days from the first day of
+    # the dataset being rewritten
+    # the stored days of the dataset are replaced by its rows, or with update only their rows of the dataset are (as
+    # DataHandler.store_dataset does with daily files)
+    def append(self, dataset, update=False):
+        index = self._index
+        ids = dataset.index.get_level_values(0)
+        if not pd.api.types.is_integer_dtype(ids.dtype) and not (isinstance(ids.dtype, pd.CategoricalDtype) and pd.api.types.is_integer_dtype(ids.dtype.categories.dtype)):
+            raise ValueError("the feature store needs integer Ids")
+        if len(index["days"]) == 0:
+            index["columns"] = list(dataset.columns)
+            index["dtypes"] = [np.asarray(dataset[column]).dtype.str for column in dataset.columns]
+            index["id_dtype"] = np.asarray(ids).dtype.str
+        elif set(dataset.columns) != set(index["columns"]):
+            raise ValueError("the columns of the dataset are not the columns of the feature store")
+
+        dates = dataset.index.get_level_values(1)
+        first = np.searchsorted(index["days"], np.datetime64(dates.min(), "ns")) if len(dataset) else len(index["days"])
+        if first < len(index["days"]):
+            stored = self.read(start=index["days"][first])
+            stored.index.names = dataset.index.names
+            replaced = stored.index.isin(dataset.index) if update else stored.index.get_level_values(1).isin(dates)
+            dataset = pd.concat([stored[~replaced], dataset])
+
+        # rows sorted by date then Id
+        ids = np.asarray(dataset.index.get_level_values(0), dtype=index["id_dtype"])
+        dates = np.asarray(dataset.index.get_level_values(1), dtype="datetime64[ns]")
+        order = np.lexsort((ids, dates))
+        days, counts = np.unique(dates[order], return_counts=True)
+
+        # every column is checked before any file is written (so that a failed append leaves the store unchanged)
+        columns = [np.asarray(dataset[column]) for column in index["columns"]]
+        for column, values, dtype in zip(index["columns"], columns, index["dtypes"]):
+            if values.dtype != np.dtype(dtype):
+                raise ValueError(f"column {column} is {values.dtype} in the dataset and {np.dtype(dtype)} in the feature store")
+
+        start = int(index["day_offsets"][first])
+        self._maps = {}
+        self._write("ids", ids[order], start)
+        for k, values in enumerate(columns):
+            self._write(k, values[order], start)
+
+        index["days"] = np.concatenate([index["days"][:first], days])
+        index["day_offsets"] = np.concatenate([index["day_offsets"][:first + 1], start + np.cumsum(counts)])
+        temporary = self._path / f"{INDEX_FILE}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as file:
+            pickle.dump(index, file)
+        os.replace(temporary, self._path / INDEX_FILE)
+
+    # writes the values of a column file from the row start (the rows after it are dropped)
+    def _write(self, column, values, start):
+        self._path.mkdir(parents=True, exist_ok=True)
+        path = self._file(column)
+        with open(path, "r+b" if path.exists() else "wb") as file:
+            file.truncate(start * values.dtype.itemsize)
+            file.seek(0, os.SEEK_END)
+            file.write(np.ascontiguousarray(values).tobytes())
+
+    # column file mapped in memory (column is the position of the column or "ids")
+    def _map(self, column):
+        if column not in self._maps:
+            dtype = np.dtype(self._index["id_dtype"] if column == "ids" else self._index["dtypes"][column])
+            # empty files can not be mapped
+            self._maps[column] = np.memmap(self._file(column), dtype=dtype, mode="r", shape=(len(self),)) if len(self) else np.empty(0, dtype=dtype)
+        return self._maps[column]
+
+    def _file(self, column):
+        return self._path / ("ids.bin" if column == "ids" else f"column{column}.bin")
+
+    # stored days between start and end (included)
+    def days_between(self, start=None, end=None):
+        first, last = self._days_between(start, end)
+        return self._index["days"][first:last]
+
+    # positions of the first day from start and of the day after the last day to end
+    def _days_between(self, start, end):
+        days = self._index["days"]
+        first = 0 if start is None else np.searchsorted(days, np.datetime64(pd.Timestamp(start), "ns"), side="left")
+        last = len(days) if end is None else np.searchsorted(days, np.datetime64(pd.Timestamp(end), "ns"), side="right")
+        return int(first), int(max(first, last))
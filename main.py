@@ -1,33 +1,101 @@
+import datetime as dt
+import numpy as np
+import pandas as pd
+from functools import partial
 from pathlib import Path
 from arguments import Parser
 from datahandling import DataHandler
-from preprocessing import Preprocessor
+from preprocessing import Preprocessor, ShardedPreprocessor
 from predictions import Predictor
+from profiling import Profiler
+from pipelining import prefetch
+from stagecache import StageCache
 
 def main():
     parser = Parser()
     mode, inp, out, start_date, end_date, mod = parser.convert_args()
+    options = parser.convert_options()
 
-    d = DataHandler()
+    profiler = Profiler() if options["profile"] else None
+    d = DataHandler(options["storage"], profiler)
     if mode == 1:
-        print("reading raw data...")
-        raw_data = d.read_raw(inp, start_date, end_date)
+        cache = None if options["stage_cache"] is None else StageCache(options["stage_cache"], options["stage_cache_size"])
+        state = None
+        if options["state"] is not None and options["state"].exists():
+            print("reading state of the previous run...")
+            state = d.read_state(options["state"])
+            # only the days after the previous run are processed
+            start_date = max(start_date, state["last_date"] + dt.timedelta(days=1))
+            # e.g. a rerun of a daily job or a day without new files: the state is kept as it is
+            if start_date > end_date or len(d.raw_days(inp, start_date, end_date)) == 0:
+                print(f"nothing to process after {state['last_date']:%Y-%m-%d}")
+                return
+        if options["shards"] is None:
+            print("reading raw data...")
+            raw_data = d.read_raw(inp, start_date, end_date, n_jobs=options["n_jobs"], cache=options["raw_cache"], compact=options["compact"])
+            raw_fingerprint = d.raw_fingerprint(inp, start_date, end_date, compact=options["compact"])
+            p = Preprocessor(raw_data, mod, state, compact=options["compact"], profiler=profiler, cache=cache, raw_fingerprint=raw_fingerprint)
+        else:
+            # every shard reads its own ids from the raw files (the shards may run in other processes, so their reads
+            # are part of the create_features stage and not profiled on their own)
+            load_raw = partial(DataHandler(options["storage"]).read_raw, inp, start_date, end_date, n_jobs=1, cache=options["raw_cache"], compact=options["compact"])
+            raw_fingerprint = partial(DataHandler(options["storage"]).raw_fingerprint, inp, start_date, end_date, compact=options["compact"])
+            p = ShardedPreprocessor(load_raw, mod, options["shards"], state, compact=options["compact"], n_jobs=options["n_jobs"], profiler=profiler, pipeline=options["pipeline"], cache=cache, raw_fingerprint=raw_fingerprint)
         print("generating targets and features...(takes time)")
-        p = Preprocessor(raw_data, mod)
-        dataset = p.create_dataset()
-        print("storing data...")
-        d.store_dataset(out, dataset)
+        if options["shards"] is None:
+            dataset = p.create_dataset()
+            print("storing data...")
+            d.store_dataset(out, dataset, update=state is not None)
+        else:
+            # the days are merged from the rows of the shards as they are stored (part of the store_dataset stage)
+            days = p.create_days()
+            print("storing data...")
+            d.store_days(out, days, update=state is not None)
+        if options["state"] is not None:
+            d.store_state(options["state"], p.create_state())
+        if cache is not None:
+            cache.print_stats()
 
-    else:
+    elif options["batch_days"] is None and not options["pipeline"]:
         print("reading daily features and targets...")
         X, y, weights = d.read_processed(inp, start_date, end_date)
         print("loading model...")
-        p = Predictor(mod)
+        p = Predictor(mod, profiler, num_threads=options["n_jobs"])
         print("predicting...")
         y_preds = p.predict(X)
         p.evaluate(y_preds, y, weights)
         print("storing predictions...")
         d.store_predictions(out, y_preds, y)
 
+    else:
+        print("loading model...")
+        p = Predictor(mod, profiler, num_threads=options["n_jobs"])
+        # reading, predicting and storing the predictions batch by batch of days (only the targets and weights are kept
+        # for the evaluation)
+        # in pipeline mode, the next batches are read and the previous ones stored while a batch is predicted
+        print("predicting and storing predictions...")
+        scored = []
+        batches = d.read_processed_batches(inp, start_date, end_date, batch_days=options["batch_days"] or 1)
+        if options["pipeline"]:
+            predicted = prefetch(_predicted(p, prefetch(batches), scored))
+        else:
+            predicted = _predicted(p, batches, scored)
+        d.store_prediction_batches(out, predicted)
+        y_preds, y, weights = zip(*scored)
+        p.evaluate(np.concatenate(y_preds), pd.concat(y), pd.concat(weights))
+
+    if profiler is not None:
+        profiler.print_report()
+        if options["profile"] is not True:
+            profiler.store_report(options["profile"])
+
+# predicts the batches of features, yielding the predictions and targets of each batch
+# (also kept in scored with the weights)
+def _predicted(p, batches, scored):
+    for X, y, weights in batches:
+        y_preds = p.predict(X)
+        scored.append((y_preds, y, weights))
+        yield y_preds, y
+
 if __name__ == "__main__":
     main()
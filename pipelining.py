@@ -0,0 +1,58 @@
+import queue
+import threading
+
+# number of items a producer can be ahead of its consumer by default
+PREFETCH_SIZE = 1
+# marks the end of the items of a producer
+_DONE = object()
+
+
+# iterates over the items of iterable, produced by a background thread while the current item is consumed
+# the producer only starts an item when less than maxsize items are ahead of the consumer (bounding the memory used),
+# its exceptions are raised to the consumer and it stops when the consumer stops iterating
+# stages chained with prefetch (e.g. prefetch(g(prefetch(f(items))))) run at the same time, each in its own thread
+def prefetch(iterable, maxsize=PREFETCH_SIZE):
+    items = queue.Queue()
+    slots = threading.Semaphore(maxsize)
+    stop = threading.Event()
+    thread = threading.Thread(target=_produce, args=(iter(iterable), items, slots, stop), daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            # the next item is produced while this one is consumed
+            slots.release()
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _produce(iterator, items, slots, stop):
+    try:
+        while _acquire(slots, stop):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                items.put((_DONE, None))
+                return
+            items.put((item, None))
+    except BaseException as e:
+        items.put((_DONE, e))
+    finally:
+        # closing the generators of the previous stages if the consumer stopped early
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
+
+
+# waits for a free slot, unless the consumer stopped
+def _acquire(slots, stop):
+    while not stop.is_set():
+        if slots.acquire(timeout=0.1):
+            return True
+    return False
@@ -1,22 +1,47 @@
 import pickle
 from sklearn.metrics import r2_score
+import numpy as np
 import pandas as pd
 import lightgbm
+from profiling import stage
+
+# number of rows given to lightgbm at a time (the features of a batch are copied as float32)
+PREDICT_BATCH_SIZE = 65536
 
 class Predictor:
     """
     Class to load the model and predict and evaluate predictions
     """
-    # getting model
-    def __init__(self, mod):
+    # getting model (with a profiler, loading, predicting and evaluating are recorded as stages)
+    # num_threads is the number of threads used by lightgbm to predict (all cores if None)
+    def __init__(self, mod, profiler=None, num_threads=None):
         self._mod = mod
-        with open((self._mod / "lgb_model1.pkl").resolve(), "rb") as file: 
-            self._model = pickle.load(file)
-    # predicting 
-    def predict(self, X):
-        X['Market Regime'] = X['Market Regime'].astype('category')
-        return self._model.predict(X) / 1e4
+        self._profiler = profiler
+        self._num_threads = num_threads
+        with stage(self._profiler, "load_model"):
+            with open((self._mod / "lgb_model1.pkl").resolve(), "rb") as file: 
+                self._model = pickle.load(file)
+        # regimes of the training data (lightgbm is given the position of the regime among them)
+        self._regimes = self._model.booster_.pandas_categorical[0]
+    # predicting (X is not modified) by batches of batch_size rows (all at once if None)
+    def predict(self, X, batch_size=PREDICT_BATCH_SIZE):
+        with stage(self._profiler, "predict") as record:
+            record["rows"] = len(X)
+            batch_size = batch_size or max(len(X), 1)
+            return np.concatenate([self._predict_batch(X.iloc[start:start + batch_size]) for start in range(0, len(X), batch_size)]) / 1e4
+    def _predict_batch(self, X):
+        return self.predict_features(self.features(X))
+    # the rows are given to lightgbm as a contiguous float32 array, with the market regime replaced by its position
+    # among the training regimes (nan if unknown) as lightgbm does with pandas frames
+    def features(self, X):
+        codes = pd.Categorical(X["Market Regime"], categories=self._regimes).codes
+        return np.insert(X.drop(columns="Market Regime").to_numpy(dtype=np.float32), X.columns.get_loc("Market Regime"), np.where(codes >= 0, codes, np.nan), axis=1)
+    # predicting rows converted by features (not divided as predict does)
+    def predict_features(self, features):
+        kwargs = {} if self._num_threads is None else {"num_threads": self._num_threads}
+        return self._model.booster_.predict(features, **kwargs)
     # getting r_squared
     def evaluate(self, y_pred, y, sample_weights):
-        print(f"Weighted R2 is {r2_score(y, y_pred, sample_weight=sample_weights)}")
-
+        with stage(self._profiler, "evaluate") as record:
+            record["rows"] = len(y)
+            print(f"Weighted R2 is {r2_score(y, y_pred, sample_weight=sample_weights)}")
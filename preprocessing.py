@@ -1,16 +1,62 @@
+import os
+import time
+import hashlib
 import numpy as np
 import pandas as pd
 import datetime as dt
 import pickle
+import tempfile
+from pathlib import Path
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from scipy import stats
 
+from datahandling import shard_of
+from profiling import stage
+from pipelining import prefetch
+from stagecache import fingerprint, files_fingerprint
+
+# hmm models already loaded by this process, by file: (modification time, model)
+_HMM_MODELS = {}
+# quantiles of the target used to clip it
+CLIP_QUANTILES = (0.01, 0.99)
+# nanoseconds in a day and from midnight to 15:30 (the ticks after it are the end of the day)
+_DAY = 24 * 3600 * 10**9
+_DAY_SEP = (15 * 3600 + 30 * 60) * 10**9
+# version of the computations of the stages, to increase when they change (the cached results of other versions are not used)
+_STAGE_VERSION = 1
+# attributes set by each cached stage (the intermediate frames of the rolling features are not cached)
+_STAGE_RESULTS = {
+    "create_target": ["_target", "_day_sep", "_est_vol", "_completed", "_clip_bounds"],
+    "create_rolling_features": ["_daily_ticks", "_intraday_ticks", "_intraday_features", "_target_history", "_daily_features", "_rolling_features"],
+    "create_weights": ["_market_weights"],
+    "create_hmm_feature": ["_index_returns", "_regimes"],
+}
+
 class Preprocessor:
     """
     Preprocessing class that handles all the preprocessing for the project
     """
-    def __init__(self, raw_df, mod):
+    # with a cache (see stagecache.StageCache), the results of the stages run by create_dataset and create_features are
+    # reused when the raw data, the state and the parameters are the same: the raw data is identified by raw_fingerprint,
+    # the fingerprint of the files raw_df was read from as it is (see DataHandler.raw_fingerprint), or else by its content
+    def __init__(self, raw_df, mod, state=None, compact=False, profiler=None, cache=None, raw_fingerprint=None):
         self._raw_df = raw_df
         self._mod = mod
+        # state of a previous run (see create_state), if given only the days of raw_df are computed
+        self._state = state
+        self._cache = cache
+        self._fingerprint = None if cache is None else fingerprint(_STAGE_VERSION, _raw_fingerprint(raw_df, raw_fingerprint), _state_fingerprint(state), compact)
+        # keys of the cached stages run so far (the key of a stage includes the keys of the stages it uses)
+        self._keys = {}
+        # in compact mode the features are float32 and the ids are replaced by int32 codes (in a copy of the frame
+        # sharing the other columns, the frame of the caller is not modified)
+        self._compact = compact
+        self._dtype = np.float32 if compact else np.float64
+        self._ids = None
+        if compact:
+            self._raw_df, self._ids, self._state = _encode_ids(raw_df, state)
+        self._profiler = profiler
 
         self._target = None
         self._daily_features = None
@@ -18,46 +64,101 @@ class Preprocessor:
         self._rolling_intraday_features = None
         self._rolling_daily_features = None
         self._hmm_feature = None
+        self._day_sep = None
+        self._est_vol = None
+        self._clip_bounds = None
+        self._completed = None
+        self._target_history = None
+        self._index_returns = None
+        self._regimes = None
         
         
-    def create_target(self, normalize_by_vol=True, clip_values=True, clip_quantiles=(0.01, 0.99)):
+    def create_target(self, normalize_by_vol=True, clip_values=True, clip_quantiles=CLIP_QUANTILES, clip_bounds=None):
         """
-        Function to create target each day from raw_data
+        Function to create target each day from raw_data (clip_bounds overrides the quantiles used to clip)
         """
-        # getting the cummulative return for each day and each id until 15:30 (included) and after 15:30 (excluded)
-        # this allows to get in the "False" index (level 2) the cummulative return at 15:30 and in the "True" the one at 16:00
-        day_sep = self._raw_df[["Id", "CumReturnResid"]].groupby(["Id", pd.Grouper(level=0, freq="D"), self._raw_df.index.time>dt.time(15,30)]).last()
+        # sorting the ticks once by id, day and part of the day (until 15:30 included or after 15:30), the ticks of
+        # each group keeping their order
+        id_codes, ids = pd.factorize(self._raw_df["Id"], sort=True)
+        times = self._raw_df.index.asi8
+        day_codes = times // _DAY
+        after = times - day_codes * _DAY > _DAY_SEP
+        first_day = day_codes.min() if len(day_codes) else 0
+        day_codes -= first_day
+        n_days = day_codes.max() + 1 if len(day_codes) else 1
+        keys = (id_codes.astype(np.int64) * n_days + day_codes) * 2 + after
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+
+        # getting the last cummulative return of each group: the "False" index (level 2) holds the cummulative
+        # return at 15:30 and the "True" one the one at 16:00
+        starts = _group_starts(keys)
+        group_keys = keys[starts]
+        day_sep = pd.DataFrame({"CumReturnResid": _group_last(self._raw_df["CumReturnResid"].to_numpy()[order], starts)}, index=pd.MultiIndex.from_arrays(
+            [ids.take(group_keys // 2 // n_days), pd.to_datetime((group_keys // 2 % n_days + first_day) * _DAY), (group_keys % 2).astype(bool)], names=["Id", None, None]))
+        if self._state is not None:
+            # the last day of each id of the previous run can now be completed if the id has a new day
+            pending = self._state["day_sep"].xs(False, level=2).index
+            new_ids = day_sep.index.get_level_values(0)[~np.asarray(day_sep.index.get_level_values(2), dtype=bool)]
+            self._completed = pending[pending.get_level_values(0).isin(new_ids)]
+            day_sep = pd.concat([self._state["day_sep"], day_sep]).sort_index()
+        self._day_sep = day_sep
+
         # let:
         #   return between yesterday 16:00 and today 15:30 be RB = (P(15:30 today) - P(16:00 yest.)) / P(16:00 yest.)
         #   return between yesterday 16:00 and today 16:30 be RT = (P(16:00 today) - P(16:00 yest.)) / P(16:00 yest.)
         #   return between today 15:30 and today 16:00 be RE = (P(16:00 today) - P(15:30 today)) / P(15:30 today)
         # we notice that RE = ((RB + 1) - (RT + 1)) / (RT + 1)
-        # we compute the return of end of day as described above here:
-        adj_end = day_sep.add(1).groupby(level=[0, 1]).pct_change().dropna().droplevel(2)
-        # getting the cummulative return at 15:30 for every day and every id
-        begin = day_sep.xs(False, level=2).shift(-1)
-        # joining both together (this also removes the days that are incomplete
-        joined = adj_end.merge(begin, how="inner", left_index=True, right_index=True)
+        # we compute the return of end of day as described above on the days with both returns (the one at 16:00
+        # falling back to the one at 15:30 when missing):
+        id_codes, day_codes, _ = day_sep.index.codes
+        after = np.asarray(day_sep.index.get_level_values(2), dtype=bool)
+        cum_return = day_sep["CumReturnResid"].to_numpy()
+        same_id = np.r_[False, id_codes[1:] == id_codes[:-1]]
+        ends = np.flatnonzero(after & np.r_[False, ~after[:-1]] & same_id & np.r_[False, day_codes[1:] == day_codes[:-1]])
+        begin_rows = np.flatnonzero(~after)
+        adj_end = np.where(np.isnan(cum_return[ends]), cum_return[ends - 1], cum_return[ends]) + 1
+        adj_end = adj_end / (cum_return[ends - 1] + 1) - 1
+        valid = ~np.isnan(adj_end)
+        ends, adj_end = ends[valid], adj_end[valid]
+        # getting the cummulative return at 15:30 of the next day of the id for every day (nan for the last day)
+        begin = np.full(len(cum_return), np.nan)
+        begin[begin_rows[:-1]] = np.where(same_id[begin_rows[1:]], cum_return[begin_rows[1:]], np.nan)
+        begin = begin[ends - 1]
         # let:
         #   return between yesterday 15:30 and yersterday 16:00 be RE = (P(16:00 yest.) - P(15:30 yest.)) / P(15:30 yest.)
         #   return between yesterday 16:00 and today 15:30 be RB = (P(15:30 today) - P(16:00 yest.)) / P(16:00 yest.)
         #   (our target) return between 15:30 yesterday and 15:30 today be T = (P(15:30 today) - P(15:30 yest.)) / P(15:30 yest.)
         # we notice that T = (CRE + 1) * (RE + 1) - 1
-        # we compute the target as described above here:
-        target = joined.stack().add(1).groupby(level=[0, 1]).prod().sub(1).rename("Target").to_frame()
-        
+        # we compute the target as described above here (without the next day, only RE is left):
+        target = np.where(np.isnan(begin), adj_end + 1, (adj_end + 1) * (begin + 1)) - 1
+        index = pd.MultiIndex.from_arrays([day_sep.index.get_level_values(0)[ends], day_sep.index.get_level_values(1)[ends]], names=["Id", None])
+
         # normalizing data by daily estimated vol
         if normalize_by_vol:
-            # daily estimated vol by Id and date
-            est_vol = self._raw_df[["Id", "EST_VOL"]].groupby(["Id", pd.Grouper(level=0, freq="D")]).first()
-            # regroup data together
-            target_vol = target.merge(est_vol, how="left", left_index=True, right_index=True)
+            # daily estimated vol by Id and date (first value of the day)
+            day_starts = _group_starts(keys // 2)
+            est_vol = self._raw_df["EST_VOL"].to_numpy()
+            first = np.minimum.reduceat(np.where(np.isnan(est_vol[order]), len(order), order), day_starts) if len(day_starts) else day_starts
+            day_keys = keys[day_starts] // 2
+            est_vol = pd.DataFrame({"EST_VOL": np.where(first < len(order), est_vol[np.minimum(first, len(order) - 1)], np.nan)},
+                                   index=pd.MultiIndex.from_arrays([ids.take(day_keys // n_days), pd.to_datetime((day_keys % n_days + first_day) * _DAY)], names=["Id", None]))
+            if self._state is not None:
+                est_vol = pd.concat([self._state["est_vol"], est_vol]).sort_index()
+            self._est_vol = est_vol
             # computed scaled by vol
-            target = (target_vol["Target"] / target_vol["EST_VOL"]).rename("Target")
-            
+            target = target / est_vol["EST_VOL"].reindex(index).to_numpy()
+        target = pd.Series(target, index=index, name="Target")
+
         # clipping values
         if clip_values:
-            target.clip(lower=target.quantile(clip_quantiles[0]), upper=target.quantile(clip_quantiles[1]), inplace=True)
+            # an incremental run keeps the bounds of the first run
+            if clip_bounds is None and self._state is not None:
+                clip_bounds = self._state["clip_bounds"]
+            if clip_bounds is None:
+                clip_bounds = partitioned_quantiles([target.to_numpy()], clip_quantiles)
+            target.clip(lower=clip_bounds[0], upper=clip_bounds[1], inplace=True)
+            self._clip_bounds = clip_bounds
         
         self._target = target
         
@@ -78,19 +179,35 @@ class Preprocessor:
         """
         Function to create features at each tick (remove cumulative)
         """
-        # getting data by Id and datetime
-        stacked_df = self._raw_df.set_index("Id", append=True).swaplevel(0,1)[["CumReturnResid", "CumVolume"]]
+        # sorting the ticks by id and datetime once (instead of grouping by id and day)
+        id_codes, ids = pd.factorize(self._raw_df["Id"], sort=True)
+        times = self._raw_df.index.to_numpy()
+        order = np.lexsort((times, id_codes))
+        id_codes, times = id_codes[order], times[order]
         # addind 1 to cumulative return (to calculate real return)
-        stacked_df["CumReturnResid"] = stacked_df["CumReturnResid"].add(1)
-        # grouping by id and day
-        grouped_df = stacked_df.groupby([pd.Grouper(level=0), pd.Grouper(freq='1D', level=1)])
-        tickdata = pd.DataFrame()
+        cum_return = self._raw_df["CumReturnResid"].to_numpy()[order] + 1
+        cum_volume = self._raw_df["CumVolume"].to_numpy()[order]
+        # each tick starts a new group if the id or the day changes
+        days = times.astype("datetime64[D]")
+        new_group = np.r_[True, (id_codes[1:] != id_codes[:-1]) | (days[1:] != days[:-1])]
+        group_start = np.maximum.accumulate(np.where(new_group, np.arange(len(times)), 0))
         # computing return: see "create_target" method to understand this way of computing returns
-        tickdata["ResidReturn"] = grouped_df["CumReturnResid"].pct_change().fillna(stacked_df["CumReturnResid"].sub(1))
+        # (as pct_change, missing cumulative returns are forward filled within the group)
+        last_valid = np.maximum.accumulate(np.where(np.isnan(cum_return), -1, np.arange(len(times))))
+        filled = np.where(last_valid >= group_start, cum_return[np.maximum(last_valid, 0)], np.nan)
+        returns = filled / np.r_[np.nan, np.where(new_group[1:], np.nan, filled[:-1])] - 1
         # computing volume as the difference between each cumulative volume step
-        tickdata["Volume"] = grouped_df["CumVolume"].diff().fillna(stacked_df["CumVolume"])
+        volumes = cum_volume - np.r_[np.nan, np.where(new_group[1:], np.nan, cum_volume[:-1])].astype(cum_volume.dtype)
+        # the first tick of each day is the cumulative value itself
+        tickdata = pd.DataFrame({
+            "ResidReturn": np.where(np.isnan(returns), cum_return - 1, returns),
+            "Volume": np.where(np.isnan(volumes), cum_volume, volumes),
+        }, index=pd.MultiIndex.from_arrays([ids.take(id_codes), times], names=["Id", None]))
+        # adding the last ticks of each id of the previous run
+        if self._state is not None:
+            tickdata = pd.concat([self._state["intraday_features"], tickdata]).sort_index()
         
-        self._intraday_features = tickdata.sort_index()
+        self._intraday_features = tickdata
         
         return self._intraday_features
     
@@ -99,131 +216,636 @@ class Preprocessor:
         Creating a dataset where each row has past daily_ticks daily returns in the past and intraday_ticks 15min returns  
         """
         
+        self._daily_ticks, self._intraday_ticks = daily_ticks, intraday_ticks
         self.create_raw_intraday_features()
-        self._daily_features = self._target.groupby(level=0).shift(1).dropna()
-        
-        # function that uses numpy strides to get rolling features
-        def strided_app(a, L):
-            nrows = ((a.size-L))+1
-            n = a.strides[0]
-            return np.lib.stride_tricks.as_strided(a, shape=(nrows,L), strides=(n,n))
+        self._target_history = self._target
+        if self._state is not None:
+            # the first new daily feature of each id is the last target of the previous run
+            target = pd.concat([self._state["target"], self._target])
+            self._target_history = target[~target.index.duplicated(keep="last")].sort_index()
+        self._daily_features = self._target_history.groupby(level=0).shift(1).dropna()
+        if self._state is not None:
+            # adding the last daily features of each id of the previous run
+            new_days = self._daily_features.index.get_level_values(1) > self._state["last_date"]
+            self._daily_features = pd.concat([self._state["daily_features"], self._daily_features[new_days]]).sort_index()
         
-        intraday_data = []
-        # going over each id
-        for Id, id_data in self._intraday_features.groupby(level=0):
-            # creating a nan dataframe so that strided app can have a longer window size than the number of datapoints until 3:30 on the first day
-            start_index = id_data.index.get_level_values(1)[0]
-            filled_up_index = pd.date_range(start=start_index - pd.DateOffset(minutes=15*intraday_ticks), end=start_index, freq="15T", inclusive="left")
-            filled_up_df = pd.DataFrame(np.nan, index=pd.MultiIndex.from_arrays([[Id] * len(filled_up_index), filled_up_index]), columns=id_data.columns)
-            id_data = pd.concat([filled_up_df, id_data])
-            # getting the rolling features for that id
-            arr = np.stack([strided_app(id_data["ResidReturn"].to_numpy(copy=False),L=intraday_ticks), strided_app(id_data["Volume"].to_numpy(copy=False),L=intraday_ticks)], axis=1)
-            mask = id_data.index[intraday_ticks-1:].get_level_values(1).time == dt.time(15,30)
-            days = id_data.index[intraday_ticks-1:].get_level_values(1)[mask].normalize()
-            # getting the data
-            intraday_data.append(pd.DataFrame(arr[mask].reshape(-1, intraday_ticks * 2), index=pd.MultiIndex.from_arrays([[Id] * len(days), days])))
-        # concatenating all the id features together
-        rolling_intraday_features = pd.concat(intraday_data)
+        # all the ids are handled at once: each id is padded with intraday_ticks nan ticks (so that the window can be
+        # longer than the number of datapoints until 3:30 on the first day) and only the 15:30 windows are kept
+        ids, times = self._intraday_features.index.get_level_values(0), self._intraday_features.index.get_level_values(1)
+        windows, positions, first_rows = _padded_windows(self._intraday_features[["ResidReturn", "Volume"]].to_numpy(dtype=self._dtype), ids, intraday_ticks)
+        # the last padding tick of each id is 15 minutes before its first tick (and is also kept if it is at 15:30)
+        pad_times = times[first_rows] - pd.Timedelta(minutes=15)
+        pad_mask, mask = _is_time(pad_times, dt.time(15, 30)), _is_time(times, dt.time(15, 30))
+        rows, order = _selected_rows(positions, first_rows, mask, pad_mask)
+        days = pd.DatetimeIndex(np.concatenate([pad_times[pad_mask], times[mask]])[order]).normalize()
+        ids = np.concatenate([ids[first_rows][pad_mask], ids[mask]])[order]
+        # getting the data
+        rolling_intraday_features = pd.DataFrame(windows[rows - intraday_ticks + 1].reshape(-1, intraday_ticks * 2), index=pd.MultiIndex.from_arrays([ids, days]))
         rolling_intraday_features.columns = ["ResidReturnT-" + str(i) for i in range(rolling_intraday_features.shape[1]//2, 0, -1)] + ["Volume-" + str(i) for i in range(rolling_intraday_features.shape[1]//2, 0, -1)]
         
         self._rolling_intraday_features = rolling_intraday_features
         
-        # doing exaclty the same but for daily features
-        daily_data = []
-        
-        for Id, id_data in self._daily_features.groupby(level=0):
-            start_index = id_data.index.get_level_values(1)[0]
-            filled_up_index = pd.date_range(start=start_index - pd.DateOffset(days=daily_ticks), end=start_index, freq="D", inclusive="left")
-            filled_up_df = pd.Series(np.nan, index=pd.MultiIndex.from_arrays([[Id] * len(filled_up_index), filled_up_index]), name=id_data.name)
-            id_data = pd.concat([filled_up_df, id_data], axis=0)
-            arr = strided_app(id_data.to_numpy(copy=False),L=daily_ticks)
-            daily_data.append(pd.DataFrame(arr, index=id_data.index[daily_ticks-1:]))
-        rolling_daily_features = pd.concat(daily_data)
+        # doing exaclty the same but for daily features (keeping every day and the last padding day of each id)
+        ids, dates = self._daily_features.index.get_level_values(0), self._daily_features.index.get_level_values(1)
+        windows, positions, first_rows = _padded_windows(self._daily_features.to_numpy(dtype=self._dtype), ids, daily_ticks)
+        pad_dates = dates[first_rows] - pd.Timedelta(days=1)
+        rows, order = _selected_rows(positions, first_rows, np.ones(len(dates), dtype=bool), np.ones(len(first_rows), dtype=bool))
+        dates = pd.DatetimeIndex(np.concatenate([pad_dates, dates])[order])
+        ids = np.concatenate([ids[first_rows], ids])[order]
+        rolling_daily_features = pd.DataFrame(windows[rows - daily_ticks + 1].reshape(len(rows), -1), index=pd.MultiIndex.from_arrays([ids, dates]))
         rolling_daily_features.columns = ["ResidReturnD-" + str(i) for i in range(rolling_daily_features.shape[1], 0, -1)] 
         
         self._rolling_daily_features = rolling_daily_features
         # concatenating both daily and intraday features together
         rolling_features = pd.concat([rolling_daily_features, rolling_intraday_features], axis=1)
+        if self._state is not None:
+            # only keeping the new days and the days of the previous run whose target is now complete
+            rolling_features = rolling_features[(rolling_features.index.get_level_values(1) > self._state["last_date"]) | rolling_features.index.isin(self._completed)]
         self._rolling_features = rolling_features.sort_index()
         return self._rolling_features
     
     # creating market regime feature
     def create_hmm_feature(self):
-        # gathering all the models to boost
-        hmm_models = []
-        for file in sorted((self._mod / "HMM").resolve().glob("*.pkl")):
-            with open(file, "rb") as file: 
-                hmm_model = pickle.load(file)
-            hmm_models.append(hmm_model)
-        # getting the "index" return (weighted average of MDV)
-        hmm_train = (self._market_weights.rename("ResidReturnD-1") * self._rolling_features["ResidReturnD-1"]).fillna(0).groupby(level=1).sum().to_numpy().reshape(-1, 1)
-        # predicting for each model
-        preds = []
-        for model in hmm_models:
-            preds.append(model.predict(hmm_train))
-        # taking the mode of each point to remove variance
-        y_pred_train = stats.mode(np.concatenate(preds).reshape(len(hmm_models), -1), keepdims=False)[0]
-        # filling up all the data (same value for all one day)
-        self._rolling_features["Market Regime"] = np.NaN
-        for i, date in enumerate(self._rolling_features.index.get_level_values(1).unique()):
-            self._rolling_features.loc[(slice(None), date), "Market Regime"] = y_pred_train[i]
+        self._index_returns, self._regimes = market_regimes(self._mod, self.create_index_returns(), self._state)
+        self._fill_regimes()
+
+    # filling up all the data (same value for all one day)
+    def _fill_regimes(self):
+        self._rolling_features["Market Regime"] = self._rolling_features.index.get_level_values(1).map(self._regimes).to_numpy(dtype=self._dtype)
+
+    # getting the "index" return (weighted average of MDV)
+    def create_index_returns(self):
+        return (self._market_weights.rename("ResidReturnD-1") * self._rolling_features["ResidReturnD-1"]).fillna(0).groupby(level=1).sum()
         
     # creating the whole dataset
-    def create_dataset(self, daily_ticks=20, intraday_ticks=26, scale_to_bps=True):
-        self.create_target()
-        self.create_rolling_features()
-        self.create_weights()
-        self.create_hmm_feature()
+    # with a state, only the new days (and the previous days whose target is now complete) are returned
+    def create_dataset(self, daily_ticks=20, intraday_ticks=26, scale_to_bps=True, clip_bounds=None):
+        with stage(self._profiler, "create_dataset") as record:
+            self.create_features(daily_ticks, intraday_ticks, clip_bounds)
+            with stage(self._profiler, "create_hmm_feature") as hmm_record:
+                if self._cached("create_hmm_feature", self.create_hmm_feature, ["create_rolling_features", "create_weights"], [_models_fingerprint(self._mod)]):
+                    self._fill_regimes()
+                hmm_record["rows"] = len(self._index_returns)
+            with stage(self._profiler, "merge") as merge_record:
+                merged = self._merge(scale_to_bps)
+                merge_record["rows"] = len(merged)
+            record["rows"] = len(merged)
+        return merged
+
+    # creating the target, the rolling features and the weights (everything but the market regime)
+    def create_features(self, daily_ticks=20, intraday_ticks=26, clip_bounds=None, clip_values=True, normalize_weights=True):
+        if self._state is not None:
+            daily_ticks, intraday_ticks = self._state["daily_ticks"], self._state["intraday_ticks"]
+            if self._raw_df.index.min().normalize() <= self._state["last_date"]:
+                raise ValueError("raw data should start after the last day of the state")
+        with stage(self._profiler, "create_target") as record:
+            self._cached("create_target", self.create_target, normalize_by_vol=True, clip_values=clip_values, clip_quantiles=CLIP_QUANTILES, clip_bounds=clip_bounds)
+            record["rows"] = len(self._target)
+        with stage(self._profiler, "create_rolling_features") as record:
+            self._cached("create_rolling_features", self.create_rolling_features, ["create_target"], daily_ticks=daily_ticks, intraday_ticks=intraday_ticks)
+            record["rows"] = len(self._rolling_features)
+        with stage(self._profiler, "create_weights") as record:
+            self._cached("create_weights", self.create_weights, normalize=normalize_weights)
+            record["rows"] = len(self._market_weights)
+
+    # runs a stage (compute(**params)), or sets its results from the cache if it was already run with the same inputs
+    # (the raw data, the state, the results of the stages it depends on, the other inputs and the parameters)
+    # returns whether the results come from the cache
+    def _cached(self, name, compute, depends=(), inputs=(), **params):
+        if self._cache is None:
+            compute(**params)
+            return False
+        key = fingerprint(name, self._fingerprint, sorted(params.items()), [self._keys[stage_name] for stage_name in depends], list(inputs))
+        self._keys[name] = key
+        results = self._cache.get(name, key)
+        if results is not None:
+            for attribute, value in results.items():
+                setattr(self, attribute, value)
+            return True
+        start = time.perf_counter()
+        compute(**params)
+        self._cache.put(name, key, {attribute: getattr(self, attribute) for attribute in _STAGE_RESULTS[name]}, time.perf_counter() - start)
+        return False
+
+    # keeping the rows with weights and target (and adding them as columns without merging)
+    def _merge(self, scale_to_bps):
         self._target.index.rename(None, level=0, inplace=True)
-        with_weights = self._rolling_features.merge(self._market_weights, left_index=True, right_index=True)
-        merged = with_weights.merge(self._target, left_index=True, right_index=True)
-        # scaling to bps the returns
+        keep = self._rolling_features.index.isin(self._market_weights.index) & self._rolling_features.index.isin(self._target.index)
+        merged = self._rolling_features.take(np.flatnonzero(keep))
+        merged["Sample Weights"] = self._market_weights.reindex(merged.index).to_numpy()
+        merged["Target"] = self._target.reindex(merged.index).to_numpy()
         if scale_to_bps:
-            merged.loc[:, merged.columns[merged.columns.str.contains('ResidReturn')].tolist() + ["Target"]] *= 1e4
+            _scale_to_bps(merged)
+        if self._compact:
+            merged = _decode_ids(merged, self._ids)
         return merged
     
-    # creating the sample weights
-    def create_weights(self):
-        market_weights = np.sqrt(self._raw_df.set_index("Id", append=True).groupby([pd.Grouper(level=0, freq="D"), pd.Grouper(level=1)])["MDV_63"].first())
-        market_weights = market_weights / market_weights.groupby(level=0).transform('sum')
+    # creating the sample weights (without normalize, the weights are not divided by their sum over the day)
+    def create_weights(self, normalize=True):
+        market_weights = np.sqrt(self._raw_df["MDV_63"].groupby([self._raw_df.index.normalize(), self._raw_df["Id"]]).first())
+        if normalize:
+            market_weights = market_weights / market_weights.groupby(level=0).transform('sum')
         market_weights.index.rename((None, None), inplace=True)
         self._market_weights = market_weights.swaplevel(0,1).rename("Sample Weights")
+        # adding the weights of the days of the previous run whose target is now complete
+        if self._state is not None:
+            self._market_weights = pd.concat([self._state["market_weights"], self._market_weights])
+
+    # creating the state needed to compute the next days with an incremental run (after create_dataset)
+    def create_state(self):
+        # the last day of each id with a 15:30 return has no target yet, it needs the next day of the id
+        pending = self._day_sep.xs(False, level=2).index.to_frame().groupby(level=0).tail(1).index
+        # keeping the ticks needed for the last 15:30 window of each id and for the next ones
+        ids, times = self._intraday_features.index.get_level_values(0), self._intraday_features.index.get_level_values(1)
+        codes, _ = pd.factorize(ids)
+        first_rows = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.zeros(0, dtype=int)
+        last_rows = np.r_[first_rows[1:], len(codes)] - 1
+        last_1530 = np.maximum.reduceat(np.where(_is_time(times, dt.time(15, 30)), np.arange(len(codes)), -1), first_rows) if len(codes) else first_rows
+        start_rows = np.maximum(first_rows, np.where(last_1530 >= first_rows, last_1530, last_rows) - self._intraday_ticks + 1)
+        state = {
+            "last_date": self._raw_df.index.max().normalize(),
+            "daily_ticks": self._daily_ticks,
+            "intraday_ticks": self._intraday_ticks,
+            "clip_bounds": self._clip_bounds,
+            "day_sep": self._day_sep[self._day_sep.index.droplevel(2).isin(pending)],
+            "est_vol": None if self._est_vol is None else self._est_vol[self._est_vol.index.isin(pending)],
+            "target": self._target_history.groupby(level=0).tail(1),
+            "daily_features": self._daily_features.groupby(level=0).tail(self._daily_ticks),
+            "intraday_features": self._intraday_features[np.arange(len(codes)) >= start_rows[codes]],
+            "market_weights": self._market_weights[self._market_weights.index.isin(pending)],
+            "index_returns": self._index_returns,
+            "regimes": self._regimes,
+        }
+        # the state always holds the ids (not the codes of the compact mode)
+        if self._compact:
+            state.update({key: _decode_ids(state[key], self._ids) for key in _STATE_BY_ID if state[key] is not None})
+        return state
          
 
             
 class Standardizer:
     """
     Module to scale down to mu=0, sigma=1 all the data, adapted from sklearn.StandardScaler() but also handles unexisting names and varying data size (because of turnover)
-    """    
-    def fit(self, series):
-
-        exp_series = series.unstack(level=0)
-        means = exp_series.mean()
-        mean_means = means.mean()
-        self._means_dict = means.to_dict()
-        self._means_dict["_MEAN"] = mean_means
-        stds = exp_series.std()
-        mean_stds = stds.mean()
-        self._stds_dict = stds.to_dict()
-        self._stds_dict["_MEAN"] = mean_stds
+    The mean and std are computed by id (first level of the index) for every column, the ids that were not fitted use the mean
+    of the means and stds of the fitted ids and the ids without std are left as they are
+    """
+    def __init__(self, columns=None):
+        # columns of the frames that are standardized (all the columns of the fitted frame if None)
+        self._columns = columns
+        # count, mean and sum of squared differences to the mean of every (id, column), aligned with the ids
+        self._ids = pd.Index([])
+        self._counts = None
+        self._means = None
+        self._m2 = None
+
+    def fit(self, data):
+        self._ids, self._counts, self._means, self._m2 = pd.Index([]), None, None, None
+        return self.partial_fit(data)
+
+    # updates the statistics with new data (e.g. a new day) without the data they were fitted on
+    def partial_fit(self, data):
+        if self._columns is None:
+            self._columns = list(_as_frame(data).columns)
+        grouped = self._values(data).groupby(level=0)
+        counts, means = grouped.count(), grouped.mean()
+        m2 = grouped.var(ddof=0) * counts
+        # adding the new ids
+        ids = self._ids.append(counts.index.difference(self._ids))
+        n_a, mean_a, m2_a = (np.zeros((len(ids), len(self._columns))) for _ in range(3))
+        if self._counts is not None:
+            n_a[:len(self._ids)], mean_a[:len(self._ids)], m2_a[:len(self._ids)] = self._counts, self._means, self._m2
+        rows = ids.get_indexer(counts.index)
+        n_b, mean_b, m2_b = (np.zeros_like(n_a) for _ in range(3))
+        n_b[rows], mean_b[rows], m2_b[rows] = counts.to_numpy(), np.nan_to_num(means.to_numpy()), np.nan_to_num(m2.to_numpy())
+        # merging the statistics of both (Chan et al. generalization of Welford's algorithm)
+        n = n_a + n_b
+        ratio = np.divide(n_b, n, out=np.zeros_like(n), where=n > 0)
+        delta = mean_b - mean_a
+        self._ids, self._counts = ids, n
+        self._means = mean_a + delta * ratio
+        self._m2 = m2_a + m2_b + delta ** 2 * n_a * ratio
         return self
-    
-    def transform(self, series):
-        exp_series = series.unstack(level=0)
-        def normalize(col):
+
+    def transform(self, data):
+        values = self._values(data)
+        rows = self._ids.get_indexer(values.index.get_level_values(0))
+        seen = (rows >= 0)[:, None]
+        means, stds = self.means(), self.stds()
+        # ids that were not fitted are scaled by the mean of the means and of the stds
+        mean = np.where(seen, means[rows], pd.DataFrame(means).mean().to_numpy())
+        std = np.where(seen, stds[rows], pd.DataFrame(stds).mean().to_numpy())
+        # fitted ids without std are not scaled
+        unscaled = seen & np.isnan(std)
+        mean[unscaled], std[unscaled] = 0, 1
+        scaled = pd.DataFrame((values.to_numpy(dtype=float) - mean) / std, index=values.index, columns=values.columns).astype(values.dtypes.to_dict())
+
+        # a series is returned unstacked (dates by ids)
+        if isinstance(data, pd.Series):
+            return scaled.iloc[:, 0].unstack(level=0)
+        return pd.concat([scaled, data.drop(columns=self._columns)], axis=1)[data.columns]
+
+    # mean and std (with one degree of freedom like pandas) of every fitted (id, column), nan without data
+    def means(self):
+        return np.where(self._counts > 0, self._means, np.nan)
+
+    def stds(self):
+        return np.sqrt(np.divide(self._m2, self._counts - 1, out=np.full_like(self._m2, np.nan), where=self._counts > 1))
+
+    def _values(self, data):
+        # a series is the single column of the standardizer whatever its name
+        data = _as_frame(data, self._columns[0] if len(self._columns) == 1 else None)
+        if not set(self._columns).issubset(data.columns):
+            raise ValueError("data does not have the columns of the standardizer")
+        return data[self._columns]
+
+
+def _as_frame(data, name=None):
+    if not isinstance(data, pd.Series):
+        return data
+    return data.to_frame() if name is None else data.to_frame(name)
+
+
+# entries of the state that are indexed by id
+_STATE_BY_ID = ["day_sep", "est_vol", "target", "daily_features", "intraday_features", "market_weights"]
+
+
+# scaling to bps the returns (in place)
+# (assigning the array avoids the alignment of the frame on its index that .loc does)
+def _scale_to_bps(data):
+    columns = data.columns[data.columns.str.contains('ResidReturn')].tolist() + ["Target"]
+    data[columns] = data[columns].to_numpy() * 1e4
+
+
+# replaces the ids of the raw data and of the state by int32 codes (following the order of the ids), the raw data
+# being a shallow copy whose other columns are not copied
+def _encode_ids(raw_df, state):
+    ids = pd.Index(raw_df["Id"].astype("category").cat.categories)
+    if state is not None:
+        for key in _STATE_BY_ID:
+            if state[key] is not None:
+                ids = ids.union(state[key].index.levels[0])
+        state = dict(state, **{key: _set_ids(state[key], ids.get_indexer) for key in _STATE_BY_ID if state[key] is not None})
+    raw_df = raw_df.copy(deep=False)
+    raw_df["Id"] = ids.get_indexer(raw_df["Id"]).astype(np.int32)
+    return raw_df, ids, state
+
+
+# gets back the ids from the codes of the first index level
+def _decode_ids(data, ids):
+    return _set_ids(data, ids.take)
+
+
+def _set_ids(data, mapping):
+    return data.set_axis(data.index.set_levels(mapping(data.index.levels[0]), level=0), axis=0)
+
+
+# gets the rolling windows of length L of data sorted by id, each id being padded with L nan rows first
+# returns the windows (window i ends at padded row i + L - 1), the padded row of each data row and the first row of each id
+def _padded_windows(values, ids, L):
+    values = values.reshape(len(values), -1)
+    codes, _ = pd.factorize(ids)
+    is_first = np.r_[True, codes[1:] != codes[:-1]] if len(codes) else np.zeros(0, dtype=bool)
+    first_rows = np.flatnonzero(is_first)
+    # every id is shifted by the padding of itself and all the ids before it
+    positions = np.arange(len(values)) + L * np.cumsum(is_first)
+    padded = np.full((len(values) + L * len(first_rows), values.shape[1]), np.nan, dtype=values.dtype)
+    padded[positions] = values
+    return np.lib.stride_tricks.sliding_window_view(padded, L, axis=0), positions, first_rows
+
+
+# gets the padded rows of the selected data rows and of the selected last padding rows (ordered like the padded data)
+# as well as the order to apply to [padding rows, data rows] to follow them
+def _selected_rows(positions, first_rows, mask, pad_mask):
+    rows = np.concatenate([positions[first_rows][pad_mask] - 1, positions[mask]])
+    order = np.argsort(rows, kind="stable")
+    return rows[order], order
+
+
+# gets the first row of each group of equal consecutive keys
+def _group_starts(keys):
+    return np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.zeros(0, dtype=int)
+
+
+# gets the last non nan value of each group of rows (nan if the group has none)
+def _group_last(values, starts):
+    last = np.maximum.reduceat(np.where(np.isnan(values), -1, np.arange(len(values))), starts) if len(starts) else starts
+    return np.where(last >= starts, values[np.maximum(last, 0)], np.nan)
+
+
+# quantiles of the non nan values of several arrays (the same as pandas, with linear interpolation) without
+# concatenating them: the ranges holding the order statistics are narrowed down by histograms over all the arrays
+# until there are few enough values in them to be gathered
+def partitioned_quantiles(parts, quantiles, max_values=2**20, bins=4096):
+    n = sum(int(np.count_nonzero(~np.isnan(part))) for part in parts)
+    if n == 0:
+        return tuple(np.nan for _ in quantiles)
+    # the position numpy computes from the percentage given by pandas, and the order statistics around it
+    positions = [(n - 1) * ((q * 100.0) / 100) for q in quantiles]
+    ranks = [(int(np.floor(position)), min(int(np.floor(position)) + 1, n - 1)) for position in positions]
+    values = _order_statistics(parts, sorted({rank for pair in ranks for rank in pair}), n, max_values, bins)
+    return tuple(np.quantile([values[lower], values[upper]], position - lower) for position, (lower, upper) in zip(positions, ranks))
+
+
+# gets the values of the given ranks among the non nan values (n of them) of the arrays
+def _order_statistics(parts, ranks, n, max_values, bins):
+    values = {}
+    # ranges of values from lower (included) to upper (excluded, no bound if None) holding some of the ranks,
+    # with the number of values below and in the range
+    ranges = [(-np.inf, None, 0, n, ranks)]
+    while ranges:
+        lower, upper, below, count, range_ranks = ranges.pop()
+        if count > max_values:
+            smallest, largest = np.inf, -np.inf
+            for part in parts:
+                selected = _between(part, lower, upper)
+                if len(selected):
+                    smallest, largest = min(smallest, selected.min()), max(largest, selected.max())
+            if smallest == largest:
+                values.update({rank: smallest for rank in range_ranks})
+                continue
+        if count > max_values and np.isfinite(largest - smallest):
+            edges = np.linspace(smallest, largest, bins + 1)[1:-1]
+            counts = np.cumsum(sum(np.bincount(np.searchsorted(edges, _between(part, lower, upper), side="right"), minlength=bins) for part in parts))
+            buckets = np.searchsorted(counts, np.array(range_ranks) - below, side="right")
+            # a range that cannot be split is gathered
+            if len(set(buckets)) > 1 or counts[buckets[0]] - (counts[buckets[0] - 1] if buckets[0] > 0 else 0) < count:
+                for bucket in sorted(set(buckets)):
+                    before = counts[bucket - 1] if bucket > 0 else 0
+                    ranges.append((edges[bucket - 1] if bucket > 0 else lower, edges[bucket] if bucket < bins - 1 else upper,
+                                   below + int(before), int(counts[bucket] - before), [rank for rank, b in zip(range_ranks, buckets) if b == bucket]))
+                continue
+        selected = np.partition(np.concatenate([_between(part, lower, upper) for part in parts]), [rank - below for rank in range_ranks])
+        values.update({rank: selected[rank - below] for rank in range_ranks})
+    return values
+
+
+def _between(values, lower, upper):
+    mask = values >= lower
+    if upper is not None:
+        mask &= values < upper
+    return values[mask]
+
+
+# checks which timestamps of a datetime index are at a given time of the day
+def _is_time(index, time):
+    return np.asarray(index - index.normalize() == pd.Timedelta(hours=time.hour, minutes=time.minute))
+
+
+# fingerprint of the raw data: the fingerprint of the files it was read from if given, or else of its content
+def _raw_fingerprint(raw_df, files=None):
+    columns = (list(raw_df.columns), list(raw_df.dtypes.astype(str)))
+    if files is not None:
+        return fingerprint(files, len(raw_df), columns)
+    content = pd.util.hash_pandas_object(raw_df).to_numpy()
+    return fingerprint(hashlib.sha256(content.tobytes()).hexdigest(), columns)
+
+
+def _state_fingerprint(state):
+    if state is None:
+        return None
+    return hashlib.sha256(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+
+def _models_fingerprint(mod):
+    return files_fingerprint(sorted((mod / "HMM").resolve().glob("*.pkl")))
+
+
+# loads the hmm models of the ensemble (only reading the files that changed since they were last loaded)
+def load_hmm_models(mod):
+    hmm_models = []
+    for file in sorted((mod / "HMM").resolve().glob("*.pkl")):
+        mtime = file.stat().st_mtime_ns
+        if file not in _HMM_MODELS or _HMM_MODELS[file][0] != mtime:
+            with open(file, "rb") as f:
+                _HMM_MODELS[file] = (mtime, pickle.load(f))
+        hmm_models.append(_HMM_MODELS[file][1])
+    return hmm_models
+
+
+# predicts the regime of each point of the index returns with every model (in parallel) and takes the mode
+def predict_regimes(hmm_models, index_returns, n_jobs=None):
+    hmm_train = np.asarray(index_returns, dtype=float).reshape(-1, 1)
+    with ThreadPoolExecutor(max_workers=min(len(hmm_models), n_jobs or os.cpu_count())) as executor:
+        preds = list(executor.map(lambda model: model.predict(hmm_train), hmm_models))
+    # taking the mode of each point to remove variance
+    return stats.mode(np.stack(preds), keepdims=False)[0]
+
+
+# decodes the regime of each day from the index returns
+# with a state, the regimes are decoded over the whole history of the index and the days of the previous run keep theirs
+# returns the index returns and the regimes of the whole history
+def market_regimes(mod, index_returns, state=None):
+    # gathering all the models to boost
+    hmm_models = load_hmm_models(mod)
+    if state is not None:
+        index_returns = pd.concat([state["index_returns"], index_returns[index_returns.index > state["last_date"]]])
+    regimes = pd.Series(predict_regimes(hmm_models, index_returns.to_numpy()), index=index_returns.index)
+    if state is not None:
+        regimes = pd.concat([state["regimes"], regimes[regimes.index > state["last_date"]]])
+    return index_returns, regimes
+
+
+class ShardedPreprocessor:
+    """
+    Preprocessing of the universe split into shards of ids that are processed one by one (or by n_jobs processes)
+    so that only the raw data of a shard is in memory at a time. The ids are independent except for the clipping
+    bounds, the weights and the index return of the market regime, which are combined across the shards
+    the rows of every shard are written by day to a temporary directory, and create_days reads them back one day at a
+    time (only the targets, weights and daily returns of all the rows are kept in memory to combine the shards)
+    """
+    # with pipeline (only with n_jobs=1), each shard is processed while the raw data of the next shard is read
+    def __init__(self, load_raw, mod, n_shards, state=None, compact=False, n_jobs=None, profiler=None, pipeline=False, cache=None, raw_fingerprint=None):
+        # load_raw(shard=(index, n_shards)) returns the raw data of the ids of a shard (e.g. a partial of DataHandler.read_raw)
+        self._load_raw = load_raw
+        # raw_fingerprint(shard=(index, n_shards)) returns the fingerprint of the raw data of a shard for the cache (e.g. a
+        # partial of DataHandler.raw_fingerprint), the content of the raw data being hashed if it is not given
+        self._raw_fingerprint = raw_fingerprint
+        self._pipeline = pipeline
+        self._mod = mod
+        self._n_shards = n_shards
+        self._state = state
+        self._compact = compact
+        self._n_jobs = n_jobs or os.cpu_count()
+        self._profiler = profiler
+        # cache of the stages of the shards (see Preprocessor)
+        self._cache = cache
+        if self._pipeline and self._parallel():
+            raise ValueError("pipeline needs the shards to be processed one after the other (n_jobs=1)")
+
+        self._shard_states = None
+        self._last_date = None
+        self._clip_bounds = None
+        self._weight_sums = None
+        self._index_returns = None
+        self._regimes = None
+
+    # creating the whole dataset (same as Preprocessor.create_dataset)
+    def create_dataset(self, daily_ticks=20, intraday_ticks=26, scale_to_bps=True, clip_bounds=None):
+        return pd.concat(list(self.create_days(daily_ticks, intraday_ticks, scale_to_bps, clip_bounds))).sort_index()
+
+    # creating the dataset as an iterator of the rows of each day (sorted by Id) to store them as they come (see
+    # DataHandler.store_days), the rows of the shards being clipped, weighted and given their market regime as the days
+    # are iterated
+    def create_days(self, daily_ticks=20, intraday_ticks=26, scale_to_bps=True, clip_bounds=None):
+        spill = tempfile.TemporaryDirectory()
+        try:
+            files, clip_bounds = self._create_shards(Path(spill.name), daily_ticks, intraday_ticks, clip_bounds)
+        except BaseException:
+            spill.cleanup()
+            raise
+        return self._merge_days(spill, files, clip_bounds, scale_to_bps)
+
+    # processes the shards, writing their rows by day to spill, and combines the clipping bounds, the weights and the
+    # market regimes of the shards (returns the files of the rows of the shards and the clipping bounds)
+    def _create_shards(self, spill, daily_ticks, intraday_ticks, clip_bounds):
+        with stage(self._profiler, "create_dataset") as record:
+            shards = [(k, self._n_shards) for k in range(self._n_shards)]
+            states = [None if self._state is None else _shard_state(self._state, shard) for shard in shards]
+            with stage(self._profiler, "create_features") as features_record:
+                load_raw = self._load_raw
+                if self._pipeline:
+                    # the shards being processed in order, each one takes the next prefetched raw data
+                    raws = prefetch(self._load_raw(shard=shard) for shard in shards)
+                    load_raw = lambda shard: next(raws)
+                process = partial(_process_shard, load_raw, self._mod, daily_ticks=daily_ticks, intraday_ticks=intraday_ticks, compact=self._compact, spill=spill, cache=self._cache, raw_fingerprint=self._raw_fingerprint)
+                results = [result for result in self._map(process, shards, states) if result is not None]
+                if self._cache is not None:
+                    for result in results:
+                        self._cache.add_stats(result["cache_stats"])
+                features_record["rows"] = sum(result["n_rows"] for result in results)
+            if len(results) == 0:
+                raise ValueError("no raw data in any shard")
+
+            # the shards do not clip their targets (the bounds are quantiles over all the ids), the daily features being
+            # copies of the targets, they are clipped with the same bounds afterwards
+            if clip_bounds is None and self._state is not None:
+                clip_bounds = self._state["clip_bounds"]
+            if clip_bounds is None:
+                clip_bounds = partitioned_quantiles([result["target"] for result in results], CLIP_QUANTILES)
+            self._clip_bounds = clip_bounds
+
+            with stage(self._profiler, "create_hmm_feature") as hmm_record:
+                self._last_date = max(result["last_date"] for result in results)
+                self._weight_sums = pd.concat([result["weight_sums"] for result in results]).groupby(level=0).sum()
+                daily_returns = pd.concat([result["daily_returns"] for result in results])
+                weighted_returns = (daily_returns["Sample Weights"] * _clip(daily_returns["ResidReturnD-1"].to_numpy(), clip_bounds)).fillna(0).groupby(level=0).sum()
+                # the days without weights are only padding days of the rolling features
+                self._index_returns, self._regimes = market_regimes(self._mod, (weighted_returns / self._weight_sums).fillna(0), self._state)
+                hmm_record["rows"] = len(self._index_returns)
+
+            # keeping the states of the shards (the shards without new data keep their previous state)
+            returned = {result["shard"]: result["state"] for result in results}
+            self._shard_states = [returned.get(shard, state) for shard, state in zip(shards, states) if shard in returned or state is not None]
+            record["rows"] = features_record["rows"]
+        return [result["rows"] for result in results], clip_bounds
+
+    # merges the rows of the shards day by day (the spill directory is removed once the days are iterated)
+    def _merge_days(self, spill, files, clip_bounds, scale_to_bps):
+        with spill:
+            readers = [_read_days(file) for file in files]
+            heads = [next(reader, None) for reader in readers]
+            while any(head is not None for head in heads):
+                day = min(head[0] for head in heads if head is not None)
+                parts = []
+                for k, head in enumerate(heads):
+                    if head is not None and head[0] == day:
+                        parts.append(head[1])
+                        heads[k] = next(readers[k], None)
+                rows = pd.concat(parts).sort_index()
+                for column in rows.columns[rows.columns.str.startswith("ResidReturnD-")].tolist() + ["Target"]:
+                    rows[column] = _clip(rows[column].to_numpy(), clip_bounds)
+                dates = rows.index.get_level_values(1)
+                rows["Market Regime"] = dates.map(self._regimes).to_numpy(dtype=rows["Market Regime"].dtype)
+                rows["Sample Weights"] /= self._weight_divisor(dates)
+                if scale_to_bps:
+                    _scale_to_bps(rows)
+                yield rows
+
+    # creating the state needed to compute the next days with an incremental run (after create_dataset)
+    def create_state(self):
+        state = {key: pd.concat([shard_state[key] for shard_state in self._shard_states]).sort_index() for key in _STATE_BY_ID}
+        state["target"] = state["target"].clip(*self._clip_bounds)
+        state["daily_features"] = state["daily_features"].clip(*self._clip_bounds)
+        market_weights = state["market_weights"]
+        state["market_weights"] = market_weights / self._weight_divisor(market_weights.index.get_level_values(1))
+        state.update({
+            "last_date": self._last_date,
+            "daily_ticks": self._shard_states[0]["daily_ticks"],
+            "intraday_ticks": self._shard_states[0]["intraday_ticks"],
+            "clip_bounds": self._clip_bounds,
+            "index_returns": self._index_returns,
+            "regimes": self._regimes,
+        })
+        return state
+
+    # sums of the weights of the new days (the weights of the days of the previous run are already normalized)
+    def _weight_divisor(self, dates):
+        divisor = self._weight_sums.reindex(dates).to_numpy()
+        if self._state is not None:
+            divisor[np.asarray(dates <= self._state["last_date"])] = 1
+        return divisor
+
+    def _parallel(self):
+        return self._n_jobs > 1 and self._n_shards > 1
+
+    # applies a function to every shard (in worker processes if there are several jobs)
+    def _map(self, func, *args):
+        if self._parallel():
+            with ProcessPoolExecutor(max_workers=min(self._n_jobs, self._n_shards)) as executor:
+                return list(executor.map(func, *args))
+        return list(map(func, *args))
+
+
+# computes the rows of the ids of a shard (module level so that it can be sent to worker processes), written by day to
+# a file of the spill directory whose path is returned
+# the rows are not clipped nor scaled, their weights are not normalized and their market regime is not set
+# also returns the (not clipped) targets, the per day sums of the weights and the weights and daily returns of the index
+def _process_shard(load_raw, mod, shard, state, daily_ticks, intraday_ticks, compact, spill, cache=None, raw_fingerprint=None):
+    raw_df = load_raw(shard=shard)
+    if len(raw_df) == 0:
+        return None
+    # the statistics of the cache are returned to the main process
+    cache = None if cache is None else cache.copy()
+    p = Preprocessor(raw_df, mod, state, compact, cache=cache, raw_fingerprint=None if cache is None or raw_fingerprint is None else raw_fingerprint(shard=shard))
+    p.create_features(daily_ticks, intraday_ticks, clip_values=False, normalize_weights=False)
+    new_weights = p._market_weights
+    if state is not None:
+        new_weights = new_weights[new_weights.index.get_level_values(1) > state["last_date"]]
+    daily_returns = pd.concat([p._market_weights, p._rolling_features["ResidReturnD-1"]], axis=1).droplevel(0)
+    p._rolling_features["Market Regime"] = np.full(len(p._rolling_features), np.nan, dtype=p._dtype)
+    rows = p._merge(scale_to_bps=False)
+    path = spill / f"shard{shard[0]}.pkl"
+    with open(path, "wb") as file:
+        for day, daily_rows in rows.groupby(level=1):
+            pickle.dump((day, daily_rows), file, protocol=pickle.HIGHEST_PROTOCOL)
+    return {
+        "shard": shard,
+        "last_date": raw_df.index.max().normalize(),
+        "rows": path,
+        "n_rows": len(rows),
+        "target": p._target.to_numpy(),
+        "weight_sums": new_weights.groupby(level=1).sum(),
+        "daily_returns": daily_returns,
+        "state": p.create_state(),
+        "cache_stats": None if cache is None else cache.stats(),
+    }
+
+
+# reads back the (day, rows) pairs written by _process_shard, in the order of the days
+def _read_days(path):
+    with open(path, "rb") as file:
+        while True:
             try:
-                mean = self._means_dict[col.name]
-                std = self._stds_dict[col.name] 
-                if pd.isnull(std):
-                    return col
-                else:
-                    return (col - mean) / std 
-            except:
-                return (col - self._means_dict["_MEAN"]) / self._stds_dict["_MEAN"]
-
-        return exp_series.apply(normalize)
-    
-        
+                yield pickle.load(file)
+            except EOFError:
+                return
 
-        
-        
\ No newline at end of file
+
+# clips values without changing their type (pandas gives float64 for float32 data with missing values)
+def _clip(values, bounds):
+    return np.clip(values, *np.asarray(bounds, dtype=values.dtype))
+
+
+# keeps the entries of a state that belong to the ids of a shard
+def _shard_state(state, shard):
+    return dict(state, **{key: state[key][shard_of(state[key].index.get_level_values(0), shard[1]) == shard[0]] for key in _STATE_BY_ID if state[key] is not None})
@@ -0,0 +1,97 @@
+import os
+import json
+import time
+import resource
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+
+class Profiler:
+    """
+    Class that records the wall time, cpu time, peak memory allocated and number of rows of each stage of the pipeline
+    (stages can be nested, and run in several threads: the cpu times and peaks of stages running at the same time then
+    include the other stages)
+    """
+    def __init__(self):
+        self._stages = []
+        self._lock = threading.Lock()
+        self._running = 0
+        self._started = False
+        # stages open in each thread (the stages of other threads are nested in the stages open in the thread of the
+        # profiler when they start their first stage)
+        self._threads = threading.local()
+        self._threads.open = self._main_open = []
+
+    # the record of the stage is yielded so that the stage can set its number of rows ("rows")
+    @contextmanager
+    def stage(self, name):
+        with self._lock:
+            if self._running == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started = True
+            self._running += 1
+            open_stages = self._open_stages()
+            # the peak of the enclosing stage so far is kept before the peak is reset for this stage
+            current, peak = tracemalloc.get_traced_memory()
+            if open_stages:
+                open_stages[-1]["peak"] = max(open_stages[-1]["peak"], peak)
+            tracemalloc.reset_peak()
+            record = {"stage": name, "depth": len(open_stages), "rows": None, "start": current, "peak": 0}
+            self._stages.append(record)
+            open_stages.append(record)
+        wall, cpu = time.perf_counter(), _cpu_time()
+        try:
+            yield record
+        finally:
+            with self._lock:
+                record["wall_time_s"] = time.perf_counter() - wall
+                record["cpu_time_s"] = _cpu_time() - cpu
+                open_stages.pop()
+                record["peak"] = max(record["peak"], tracemalloc.get_traced_memory()[1])
+                if open_stages:
+                    open_stages[-1]["peak"] = max(open_stages[-1]["peak"], record["peak"])
+                record["peak_memory_mb"] = record["peak"] / 2**20
+                record["added_memory_mb"] = (record["peak"] - record["start"]) / 2**20
+                record["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+                self._running -= 1
+                if self._running == 0 and self._started:
+                    tracemalloc.stop()
+                    self._started = False
+
+    def _open_stages(self):
+        if not hasattr(self._threads, "open"):
+            self._threads.open = list(self._main_open)
+        return self._threads.open
+
+    # gets the recorded stages (in the order they started)
+    def report(self):
+        return [{key: value for key, value in record.items() if key not in ("start", "peak")} for record in self._stages]
+
+    def print_report(self):
+        for stage in self.report():
+            rows = "" if stage["rows"] is None else f", {stage['rows']} rows"
+            print(f"{'  ' * stage['depth']}{stage['stage']}: {stage['wall_time_s']:.2f}s (cpu {stage['cpu_time_s']:.2f}s), "
+                  f"peak {stage['peak_memory_mb']:.1f}MB (+{stage['added_memory_mb']:.1f}MB), max rss {stage['max_rss_mb']:.1f}MB{rows}")
+
+    def store_report(self, path):
+        with open(path, "w") as file:
+            json.dump({"stages": self.report()}, file, indent=2)
+
+
+# stage of an optional profiler (without profiler, the record yielded is not kept)
+def stage(profiler, name):
+    if profiler is None:
+        return _no_stage()
+    return profiler.stage(name)
+
+
+@contextmanager
+def _no_stage():
+    yield {}
+
+
+# cpu time of the process and of its finished child processes (the workers of the process pools)
+def _cpu_time():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
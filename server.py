@@ -0,0 +1,207 @@
+import io
+import json
+import time
+import struct
+import socket
+import argparse
+import threading
+import socketserver
+from collections import deque
+from functools import partial
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from datahandling import DataHandler
+from predictions import Predictor
+from compiled import CompiledModels
+from preprocessing import load_hmm_models, predict_regimes
+
+# every message is a type byte, the length of the payload (8 bytes) and the payload
+# feature rows and predictions are sent as arrow (feather) tables, stats and errors as json/text
+# (PREDICT_DAYS requests have all the rows of their days, see PredictionServer.predict)
+PREDICT, PREDICT_DAYS, STATS, ERROR = b"P", b"D", b"S", b"E"
+
+
+def _send(sock, kind, payload):
+    sock.sendall(kind + struct.pack("!Q", len(payload)) + payload)
+
+
+def _recv(sock):
+    header = _recv_exact(sock, 9)
+    if header is None:
+        return None, None
+    return header[:1], _recv_exact(sock, struct.unpack("!Q", header[1:])[0])
+
+
+def _recv_exact(sock, n):
+    chunks = []
+    while n > 0:
+        chunk = sock.recv(min(n, 1 << 20))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+
+# frames are sent without their index (feather only stores columns)
+def _to_bytes(df):
+    buffer = io.BytesIO()
+    df.reset_index().to_feather(buffer)
+    return buffer.getvalue()
+
+
+def _from_bytes(payload, index):
+    return pd.read_feather(io.BytesIO(payload)).set_index(index)
+
+
+class PredictionServer(socketserver.ThreadingTCPServer):
+    """
+    Server that keeps the model and the hmm ensemble loaded and predicts batches of feature rows sent by clients
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    # with compiled (the path of a compiled models file, see compiled.py, built from the models of mod) the hmm ensemble
+    # is mapped from it instead of being unpickled and decodes with its vectorized viterbi (the rows are still predicted
+    # by lightgbm, faster than the compiled trees)
+    def __init__(self, mod, address=("127.0.0.1", 8765), state=None, scale_to_bps=True, compiled=None):
+        super().__init__(address, _PredictionHandler)
+        self._predictor = Predictor(mod)
+        if compiled is None:
+            self._decode = partial(predict_regimes, load_hmm_models(mod))
+        else:
+            self._decode = CompiledModels(compiled, mod).predict_regimes
+        self._data_handler = DataHandler()
+        # index returns and regimes of the preprocessing state (needed to decode the regime of rows sent without it),
+        # extended with the days decoded since
+        self._index_returns = None if state is None else state["index_returns"]
+        self._regimes = None if state is None else state["regimes"]
+        self._scale = 1e4 if scale_to_bps else 1
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=100000)
+
+    # predicting a batch of rows indexed by (Id, Date) as read_processed returns them
+    # rows sent without their Market Regime need it to be known: the days of the state, or the days after it that were
+    # sent as complete days (complete_days: the batch has all the rows of its days, whose regimes are decoded from
+    # their index returns and kept for the next batches)
+    def predict(self, X, complete_days=False):
+        if "Market Regime" not in X.columns:
+            X = X.assign(**{"Market Regime": self._regimes_of(X, complete_days)})
+        X = X.drop(["Sample Weights", "Target"], axis=1, errors="ignore")
+        with self._lock:
+            y_preds = self._predictor.predict(X)
+        return self._data_handler.format_predictions(y_preds, X.index)
+
+    # getting the regime of each row (decoding the new complete days with the index return of their rows, once)
+    def _regimes_of(self, X, complete_days):
+        if self._regimes is None:
+            raise ValueError("rows without Market Regime need a preprocessing state")
+        dates = X.index.get_level_values(1)
+        with self._lock:
+            new_rows = ~dates.isin(self._regimes.index)
+            if new_rows.any():
+                # the index return of a day is a sum over the whole universe, a part of the day would give another regime
+                if not complete_days:
+                    raise ValueError("rows of days without a known regime need their Market Regime or to be sent as complete days")
+                index_returns = (X["Sample Weights"] * X["ResidReturnD-1"] / self._scale)[new_rows].fillna(0).groupby(level=1).sum()
+                if index_returns.index.min() <= self._regimes.index.max():
+                    raise ValueError("complete days should be sent in date order, after the days with a known regime")
+                history = pd.concat([self._index_returns, index_returns])
+                self._regimes = pd.concat([self._regimes, pd.Series(self._decode(history.to_numpy())[-len(index_returns):], index=index_returns.index)])
+                self._index_returns = history
+            regimes = self._regimes
+        return dates.map(regimes).to_numpy(dtype=float)
+
+    def record_latency(self, seconds):
+        self._latencies.append(seconds)
+
+    # latency percentiles of the requests served (in milliseconds)
+    def latency_stats(self):
+        latencies = np.array(self._latencies) * 1e3
+        if len(latencies) == 0:
+            return {"requests": 0}
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        return {"requests": len(latencies), "p50_ms": p50, "p90_ms": p90, "p99_ms": p99, "max_ms": latencies.max()}
+
+
+class _PredictionHandler(socketserver.BaseRequestHandler):
+    """
+    Handles the requests of one client connection
+    """
+    def handle(self):
+        while True:
+            kind, payload = _recv(self.request)
+            if kind is None:
+                return
+            start = time.perf_counter()
+            try:
+                if kind in (PREDICT, PREDICT_DAYS):
+                    X = _from_bytes(payload, ["Id", "Date"])
+                    _send(self.request, PREDICT, _to_bytes(self.server.predict(X, complete_days=kind == PREDICT_DAYS)))
+                    self.server.record_latency(time.perf_counter() - start)
+                elif kind == STATS:
+                    _send(self.request, STATS, json.dumps(self.server.latency_stats()).encode())
+                else:
+                    raise ValueError(f"unknown request type {kind}")
+            except Exception as e:
+                _send(self.request, ERROR, str(e).encode())
+
+
+class PredictionClient:
+    """
+    Client of the PredictionServer (keeps its connection open between requests)
+    """
+    def __init__(self, address=("127.0.0.1", 8765)):
+        self._sock = socket.create_connection(address)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    # getting the predictions (indexed by Date with Time, Id and Pred columns) of rows indexed by (Id, Date)
+    # (complete_days when X has all the rows of its days, see PredictionServer.predict)
+    def predict(self, X, complete_days=False):
+        return _from_bytes(self._request(PREDICT_DAYS if complete_days else PREDICT, _to_bytes(X)), "Date")
+
+    def stats(self):
+        return json.loads(self._request(STATS, b""))
+
+    def _request(self, kind, payload):
+        _send(self._sock, kind, payload)
+        kind, payload = _recv(self._sock)
+        if kind is None:
+            raise ConnectionError("server closed the connection")
+        if kind == ERROR:
+            raise ValueError(payload.decode())
+        return payload
+
+    def close(self):
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', required=True, help="models path")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', default=8765, type=int)
+    parser.add_argument('--state', help="preprocessing state file (to decode the regime of rows sent without it)")
+    parser.add_argument('--compiled', help="compiled models file (see compiled.py) used to decode the regimes instead of the pickled hmm models")
+    args = parser.parse_args()
+
+    state = None if args.state is None else DataHandler().read_state((Path.cwd() / args.state).resolve())
+    compiled = None if args.compiled is None else (Path.cwd() / args.compiled).resolve()
+    with PredictionServer((Path.cwd() / args.p).resolve(), (args.host, args.port), state, compiled=compiled) as server:
+        print(f"serving predictions on {args.host}:{args.port}...")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print(f"latencies: {server.latency_stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import os
+import pickle
+import hashlib
+
+# maximum size of the cache directory by default (in bytes)
+CACHE_SIZE = 2 * 2**30
+
+
+# hash of the representation of the parts (parameters, other fingerprints...)
+def fingerprint(*parts):
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+# fingerprint of files by their name, size and modification time (as make does, their content is not read)
+def files_fingerprint(files):
+    return fingerprint(*[(file.name, file.stat().st_size, file.stat().st_mtime_ns) for file in files])
+
+
+class StageCache:
+    """
+    On disk cache of the results of stages, stored by the fingerprint of their inputs and parameters (one pickle file per
+    result): the least recently used results are removed when the files are over max_bytes
+    the hits and misses of each stage are counted, with the time the hits saved (the time the results took to compute)
+    """
+    def __init__(self, path, max_bytes=CACHE_SIZE):
+        self._path = path
+        self._path.mkdir(parents=True, exist_ok=True)
+        self._max_bytes = max_bytes
+        # statistics by stage
+        self._stats = {}
+        self._evictions = 0
+
+    # cache of the same directory with its own statistics (e.g. for a worker, see add_stats)
+    def copy(self):
+        return StageCache(self._path, self._max_bytes)
+
+    # gets the result of a stage (None if it is not in the cache)
+    def get(self, stage, key):
+        file = self._path / f"{key}.pkl"
+        stats = self._stage_stats(stage)
+        try:
+            with open(file, "rb") as f:
+                entry = pickle.load(f)
+            # the access time is not updated by every file system, the modification time is used instead
+            os.utime(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            stats["misses"] += 1
+            return None
+        stats["hits"] += 1
+        stats["bytes_read"] += file.stat().st_size
+        stats["saved_time_s"] += entry["seconds"]
+        return entry["result"]
+
+    # stores the result of a stage that took seconds to compute
+    def put(self, stage, key, result, seconds):
+        data = pickle.dumps({"result": result, "seconds": seconds}, protocol=pickle.HIGHEST_PROTOCOL)
+        file = self._path / f"{key}.pkl"
+        # written under another name first as other processes may be reading the same file
+        temporary = file.with_suffix(f".{os.getpid()}.tmp")
+        with open(temporary, "wb") as f:
+            f.write(data)
+        os.replace(temporary, file)
+        stats = self._stage_stats(stage)
+        stats["bytes_written"] += len(data)
+        stats["computing_time_s"] += seconds
+        self._evict()
+
+    # removes the least recently used results until the cache fits in max_bytes
+    def _evict(self):
+        entries = []
+        for file in self._path.glob("*.pkl"):
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, file))
+        size = sum(entry[1] for entry in entries)
+        for _, file_size, file in sorted(entries):
+            if size <= self._max_bytes:
+                break
+            file.unlink(missing_ok=True)
+            size -= file_size
+            self._evictions += 1
+
+    def _stage_stats(self, stage):
+        if stage not in self._stats:
+            self._stats[stage] = {"hits": 0, "misses": 0, "bytes_read": 0, "bytes_written": 0, "saved_time_s": 0.0, "computing_time_s": 0.0}
+        return self._stats[stage]
+
+    # statistics of every stage and number of results evicted
+    def stats(self):
+        return {"stages": {stage: dict(stats) for stage, stats in self._stats.items()}, "evictions": self._evictions}
+
+    # adds the statistics of another cache object (e.g. of a worker process)
+    def add_stats(self, stats):
+        for stage, counts in stats["stages"].items():
+            own = self._stage_stats(stage)
+            for name, value in counts.items():
+                own[name] += value
+        self._evictions += stats["evictions"]
+
+    def print_stats(self):
+        for stage, stats in self._stats.items():
+            print(f"stage cache {stage}: {stats['hits']} hits ({stats['bytes_read'] / 2**20:.1f}MB read, {stats['saved_time_s']:.2f}s saved), "
+                  f"{stats['misses']} misses ({stats['bytes_written'] / 2**20:.1f}MB written, {stats['computing_time_s']:.2f}s computing)")
+        print(f"stage cache: {self._evictions} results evicted")
@@ -0,0 +1,242 @@
+import numpy as np
+import pandas as pd
+
+from preprocessing import load_hmm_models, predict_regimes
+
+# time of the bar at which the rows of the day are emitted
+EMIT_TIME = pd.Timedelta(hours=15, minutes=30)
+
+
+class FeatureStreamer:
+    """
+    Computes the rows of create_dataset from live 15 minutes bars: the bars of each Id update its state in O(1) (ring
+    buffers of its last intraday ticks and daily returns, held for all the Ids in preallocated arrays) and the rows of
+    the day are emitted as soon as the 15:30 bar lands (without their target, which needs the next day)
+    the streamer starts from the state of a batch run (see Preprocessor.create_state) and its rows are the rows the
+    incremental runs of every day store, except when Ids only have bars after 15:30 (the weights of the day are then
+    normalized without them) or have no bar after 15:30 (the index return of the day then counts their return until the
+    day ends, the regime of the rows being decoded at 15:30)
+    """
+    def __init__(self, state, mod, scale_to_bps=True, capacity=1024):
+        self._hmm_models = load_hmm_models(mod)
+        self._scale = 1e4 if scale_to_bps else 1
+        self._clip_bounds = state["clip_bounds"]
+        self._daily_ticks, self._intraday_ticks = state["daily_ticks"], state["intraday_ticks"]
+        self._index_returns = state["index_returns"]
+        self._regimes = state["regimes"]
+        self._last_date = state["last_date"]
+        self._columns = (["ResidReturnD-" + str(i) for i in range(self._daily_ticks, 0, -1)]
+                         + ["ResidReturnT-" + str(i) for i in range(self._intraday_ticks, 0, -1)]
+                         + ["Volume-" + str(i) for i in range(self._intraday_ticks, 0, -1)])
+        self._ids = pd.Index([], dtype=np.int64)
+        self._arrays = {}
+        self._allocate(capacity)
+        self._day = None
+        self._emitted = False
+        self._load_state(state)
+
+    # index returns and regimes of every day (the regime of the last day decoded with all its bars once it ended)
+    @property
+    def regimes(self):
+        return self._regimes
+
+    @property
+    def index_returns(self):
+        return self._index_returns
+
+    # starts a new day (after the last day of the state) with its daily data (MDV_63 and EST_VOL indexed by Id)
+    def start_day(self, day, daily):
+        day = pd.Timestamp(day).normalize()
+        if self._day is not None:
+            raise ValueError(f"day {self._day.date()} is not ended")
+        if day <= self._last_date:
+            raise ValueError("days should follow the last day of the state")
+        a = self._arrays
+        for name, fill in _DAY_ARRAYS.items():
+            a[name][:] = fill
+        slots = self._slots(daily.index)
+        a["mdv"][slots] = daily["MDV_63"].to_numpy(dtype=float)
+        a["est_vol"][slots] = daily["EST_VOL"].to_numpy(dtype=float)
+        self._day, self._emitted = day, False
+
+    # updates the Ids of a bar (time, and cumulative return and volume of each Id since the start of the day)
+    # returns the rows of the day (as create_dataset, without Target) once the 15:30 bar is updated, None otherwise
+    def update(self, time, ids, cum_returns, cum_volumes):
+        time = pd.Timestamp(time)
+        if self._day is None or time.normalize() != self._day:
+            raise ValueError("bars should be updated between the start and the end of their day")
+        rows = None
+        after = time - self._day > EMIT_TIME
+        if after and not self._emitted:
+            # no 15:30 bar at all
+            rows = self._emit()
+        a = self._arrays
+        slots = self._slots(ids)
+        cum_returns = np.asarray(cum_returns, dtype=float)
+        cum_return = cum_returns + 1
+        cum_volume = np.asarray(cum_volumes, dtype=float)
+        # the same returns and volumes as create_raw_intraday_features: returns of the cumulative return forward
+        # filled within the day and differences of the cumulative volume, the first bar of the day being the
+        # cumulative values themselves
+        previous = np.where(a["in_day"][slots], a["filled"][slots], np.nan)
+        filled = np.where(np.isnan(cum_return), previous, cum_return)
+        returns = filled / previous - 1
+        volumes = cum_volume - np.where(a["in_day"][slots], a["volume"][slots], np.nan)
+        ticks = np.stack([np.where(np.isnan(returns), cum_return - 1, returns), np.where(np.isnan(volumes), cum_volume, volumes)], axis=1)
+        a["ticks"][slots, a["tick_pos"][slots] % self._intraday_ticks] = ticks
+        a["tick_pos"][slots] += 1
+        a["filled"][slots], a["volume"][slots], a["in_day"][slots] = filled, cum_volume, True
+        # last cumulative returns until 15:30 included and after it (for the target)
+        part, seen = ("after", "seen_after") if after else ("before", "seen_before")
+        a[part][slots] = np.where(np.isnan(cum_returns), a[part][slots], cum_returns)
+        a[seen][slots] = True
+        if time - self._day == EMIT_TIME:
+            a["has_emit_bar"][slots] = True
+            rows = self._emit()
+        return rows
+
+    # ends the day: the end of day returns of the Ids wait for the next day to complete their target, and the index
+    # return and regime of the day are computed with all the bars of the day
+    # returns the rows of the day if no bar reached 15:30 (None otherwise)
+    def end_day(self):
+        if self._day is None:
+            raise ValueError("no day is started")
+        rows = None if self._emitted else self._emit()
+        a = self._arrays
+        slots = np.flatnonzero(a["seen_before"] & a["seen_after"])
+        end = (np.where(np.isnan(a["after"][slots]), a["before"][slots], a["after"][slots]) + 1) / (a["before"][slots] + 1) - 1
+        valid = ~np.isnan(end)
+        slots, end = slots[valid], end[valid]
+        a["pending"][slots], a["pending_end"][slots], a["pending_vol"][slots] = True, end, a["est_vol"][slots]
+        # only the rows with a target have a daily return in the index return
+        has_target = np.zeros(len(a["in_day"]), dtype=bool)
+        has_target[slots] = True
+        index_return = self._index_return(np.where(has_target, a["feature"], np.nan))
+        self._index_returns = pd.concat([self._index_returns, pd.Series([index_return], index=[self._day])])
+        self._regimes = pd.concat([self._regimes, pd.Series([self._decode(self._index_returns)], index=[self._day])])
+        self._last_date, self._day = self._day, None
+        return rows
+
+    # rows of the Ids with bars until 15:30
+    def _emit(self):
+        self._emitted = True
+        a = self._arrays
+        slots = np.flatnonzero(a["seen_before"])
+        # the target of the last day of the Ids is complete with their 15:30 return
+        pending = slots[a["pending"][slots]]
+        begin = a["before"][pending]
+        end = a["pending_end"][pending]
+        target = np.where(np.isnan(begin), end + 1, (end + 1) * (begin + 1)) - 1
+        self._push_returns(pending, np.clip(target / a["pending_vol"][pending], *self._clip_bounds))
+        a["pending"][pending] = False
+
+        # windows of the last daily returns and of the last ticks (oldest first), nan without daily features or 15:30 bar
+        order = (a["return_pos"][slots, None] + np.arange(self._daily_ticks)) % self._daily_ticks
+        daily = np.where(a["has_return"][slots, None], a["returns"][slots[:, None], order], np.nan)
+        a["feature"][slots] = daily[:, -1]
+        order = (a["tick_pos"][slots, None] + np.arange(self._intraday_ticks)) % self._intraday_ticks
+        ticks = np.where(a["has_emit_bar"][slots, None, None], a["ticks"][slots[:, None], order], np.nan)
+        rows = pd.DataFrame(np.concatenate([daily, ticks[:, :, 0], ticks[:, :, 1]], axis=1), columns=self._columns,
+                            index=pd.MultiIndex.from_arrays([self._ids[slots], np.full(len(slots), self._day)]))
+
+        weights = self._weights()
+        index_returns = pd.concat([self._index_returns, pd.Series([self._index_return(a["feature"], weights)], index=[self._day])])
+        rows["Market Regime"] = float(self._decode(index_returns))
+        rows["Sample Weights"] = weights.reindex(rows.index.get_level_values(0)).to_numpy()
+        rows = rows.sort_index()
+        returns = rows.columns[rows.columns.str.startswith("ResidReturn")]
+        rows[returns] *= self._scale
+        return rows
+
+    # weights of the Ids with bars in the day (the square root of their MDV_63 over the sum of the day)
+    def _weights(self):
+        a = self._arrays
+        slots = np.flatnonzero(a["in_day"])
+        weights = pd.Series(np.sqrt(a["mdv"][slots]), index=self._ids[slots]).sort_index()
+        return weights / weights.groupby(np.zeros(len(weights))).transform("sum")
+
+    # index return of the day: the sum of the weighted daily returns (nan for the Ids without daily return)
+    def _index_return(self, features, weights=None):
+        weights = self._weights() if weights is None else weights
+        returns = features[self._ids.get_indexer(weights.index)]
+        return (weights * returns).fillna(0).groupby(np.zeros(len(weights))).sum().sum()
+
+    def _decode(self, index_returns):
+        return predict_regimes(self._hmm_models, index_returns.to_numpy())[-1]
+
+    # preallocated arrays of the state of every Id (grown when new Ids arrive)
+    def _allocate(self, capacity):
+        shapes = dict(_ARRAYS, ticks=((self._intraday_ticks, 2), np.nan), returns=((self._daily_ticks,), np.nan))
+        for name, (shape, fill) in shapes.items():
+            array = np.full((capacity,) + shape, fill, dtype=np.float64 if isinstance(fill, float) else type(fill))
+            if name in self._arrays:
+                array[:len(self._arrays[name])] = self._arrays[name]
+            self._arrays[name] = array
+
+    # slots of the Ids in the arrays (adding the new Ids)
+    def _slots(self, ids):
+        ids = np.asarray(ids)
+        slots = self._ids.get_indexer(ids)
+        if (slots < 0).any():
+            self._ids = self._ids.append(pd.Index(pd.unique(ids[slots < 0])))
+            if len(self._ids) > len(self._arrays["in_day"]):
+                self._allocate(2 * len(self._ids))
+            slots = self._ids.get_indexer(ids)
+        return slots
+
+    def _load_state(self, state):
+        a = self._arrays
+        # last ticks of every Id and last daily features (the daily returns until the last target but one)
+        for name, position, values, length in [("ticks", "tick_pos", state["intraday_features"], self._intraday_ticks),
+                                               ("returns", "return_pos", state["daily_features"], self._daily_ticks)]:
+            ids = values.index.get_level_values(0)
+            codes, unique = pd.factorize(ids)
+            slots = self._slots(unique)
+            first = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.zeros(0, dtype=int)
+            counts = np.diff(np.r_[first, len(codes)])
+            rank = np.arange(len(codes)) - np.repeat(first, counts)
+            kept = rank >= np.repeat(counts - length, counts)
+            a[name][slots[codes[kept]], (rank - np.repeat(np.maximum(counts - length, 0), counts))[kept]] = values.to_numpy(dtype=float).reshape(len(codes), -1)[kept].reshape((-1,) + a[name].shape[2:])
+            a[position][slots] = np.minimum(counts, length)
+        # the days with 15:30 and later returns at the end of the state wait for the next day to complete their target
+        day_sep = state["day_sep"]["CumReturnResid"]
+        before = day_sep.xs(False, level=2)
+        after = day_sep.xs(True, level=2).reindex(before.index)
+        end = (np.where(np.isnan(after), before, after) + 1) / (before.to_numpy() + 1) - 1
+        slots = self._slots(before.index.get_level_values(0))
+        a["pending"][slots] = before.index.isin(day_sep.xs(True, level=2).index) & ~np.isnan(end)
+        a["pending_end"][slots] = end
+        if state["est_vol"] is not None:
+            a["pending_vol"][slots] = state["est_vol"]["EST_VOL"].reindex(before.index).to_numpy()
+        # the last target of the other Ids is complete
+        target = state["target"]
+        slots = self._slots(target.index.get_level_values(0))
+        complete = ~a["pending"][slots]
+        self._push_returns(slots[complete], target.to_numpy()[complete])
+
+    # pushes the daily returns that are known (nan returns are not daily features: the next row has none)
+    def _push_returns(self, slots, values):
+        a = self._arrays
+        known = ~np.isnan(values)
+        a["has_return"][slots] = known
+        slots, values = slots[known], values[known]
+        a["returns"][slots, a["return_pos"][slots] % self._daily_ticks] = values
+        a["return_pos"][slots] += 1
+
+
+# arrays of the state of the Ids (shape of an Id and initial value), the ring buffers of the last intraday ticks
+# (ResidReturn, Volume) and daily returns (clipped targets) having the shape of the windows
+_ARRAYS = {
+    "tick_pos": ((), 0), "return_pos": ((), 0),
+    # whether the last daily return is known (the next row has daily features)
+    "has_return": ((), False),
+    # end of day return and volatility of the last day whose target waits for the 15:30 return of the next day
+    "pending": ((), False), "pending_end": ((), np.nan), "pending_vol": ((), np.nan),
+}
+# arrays of the current day: forward filled cumulative return and cumulative volume of the last bar, last cumulative
+# return until 15:30 included and after it, daily data and last daily return of the row
+_DAY_ARRAYS = {
+    "in_day": False, "filled": np.nan, "volume": np.nan, "seen_before": False, "before": np.nan, "seen_after": False,
+    "after": np.nan, "has_emit_bar": False, "mdv": np.nan, "est_vol": np.nan, "feature": np.nan,
+}
+_ARRAYS.update({name: ((), fill) for name, fill in _DAY_ARRAYS.items()})